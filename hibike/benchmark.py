@@ -0,0 +1,453 @@
+"""
+Benchmarks for the Hibike packet pipeline and hibike process.
+
+usage:
+$ python3 benchmark.py [checksum] [cobs] [send] [engines] [disable]
+
+The engines and disable benchmarks run simulated devices on
+pseudo-terminals, so they only work on Linux.
+"""
+import argparse
+import multiprocessing
+import os
+import queue
+import random
+import selectors
+import statistics
+import tempfile
+import threading
+import time
+import timeit
+
+# pylint: disable=import-error
+import hibike_message as hm
+import hibike_process
+
+
+def device_data_packets():
+    """
+    Build a full DeviceData packet (before COBS encoding) for every device
+    type in hibikeDevices.json, with every readable parameter set.
+
+    Returns:
+        A list of (device name, packet bytes) tuples.
+    """
+    sample_values = {"bool": True, "float": 1.5, "double": 1.5}
+    packets = []
+    for device_id, device in sorted(hm.DEVICES.items()):
+        params_and_values = [(param["name"], sample_values.get(param["type"], 1))
+                             for param in device["params"] if param["read"]]
+        packet = hm.make_device_data(device_id, params_and_values).to_bytes()
+        packet.append(hm.checksum(packet))
+        packets.append((device["name"], packet))
+    return packets
+
+
+def bench_cobs(args):
+    """
+    Print COBS encode and decode throughput, in packets per second,
+    for each device's DeviceData packet.
+    """
+    number = args.number
+    print("COBS implementation: %s" % ("C" if hm._cobs is not None else "Python")) # pylint: disable=protected-access
+    print("%-15s %5s %14s %14s" % ("device", "bytes", "encode pkt/s", "decode pkt/s"))
+    for name, packet in device_data_packets():
+        encoded = hm.cobs_encode(packet)
+        encode_time = timeit.timeit(lambda: hm.cobs_encode(packet), number=number) # pylint: disable=cell-var-from-loop
+        decode_time = timeit.timeit(lambda: hm.cobs_decode(encoded), number=number) # pylint: disable=cell-var-from-loop
+        print("%-15s %5d %14.0f %14.0f" % (name, len(packet),
+                                          number / encode_time, number / decode_time))
+
+
+def bench_checksum(args):
+    """
+    Print checksum throughput, in packets per second, for each
+    device's DeviceData packet.
+    """
+    number = args.number
+    print("%-15s %5s %14s" % ("device", "bytes", "checksum pkt/s"))
+    for name, packet in device_data_packets():
+        data = memoryview(packet)[:-1]
+        checksum_time = timeit.timeit(lambda: hm.checksum(data), number=number) # pylint: disable=cell-var-from-loop
+        print("%-15s %5d %14.0f" % (name, len(data), number / checksum_time))
+
+
+class NullSerial:
+    """
+    A stand-in for a serial port that discards everything written to it.
+    """
+    def write(self, data):
+        """
+        Discard DATA.
+        """
+        return len(data)
+
+
+def bench_send(args):
+    """
+    Print how many DeviceWrite packets per second can be framed and
+    written out for each device with writable parameters.
+    """
+    number = args.number
+    print("%-15s %14s" % ("device", "send pkt/s"))
+    conn = NullSerial()
+    frame = bytearray(hm.MAX_FRAME_SIZE)
+    for device_id, device in sorted(hm.DEVICES.items()):
+        params_and_values = [(param["name"], 1) for param in device["params"] if param["write"]]
+        if not params_and_values:
+            continue
+        message = hm.make_device_write(device_id, params_and_values)
+        send_time = timeit.timeit(lambda: hm.send(conn, message, frame), number=number) # pylint: disable=cell-var-from-loop
+        print("%-15s %14.0f" % (device["name"], number / send_time))
+
+
+class SimulatedDevices:
+    """
+    ExampleDevices on the master ends of pseudo-terminals, run by a
+    background thread.
+
+    Each device streams DeviceData packets whose "natsuki" parameter is
+    the `time.monotonic_ns()` at which the packet was sent, so the
+    receiver can work out how old the data is. Like real devices, they
+    also send a heartbeat request every HEARTBEAT_INTERVAL seconds.
+    """
+    DEVICE_ID = hm.device_name_to_id("ExampleDevice")
+    HEARTBEAT_INTERVAL = 0.5
+
+    def __init__(self, count):
+        self.selector = selectors.DefaultSelector()
+        self.ports = []
+        self.slave_fds = []
+        self.states = []
+        for _ in range(count):
+            master, slave = os.openpty()
+            state = {
+                "fd": master,
+                "decoder": hm.FrameDecoder(),
+                "uid": (self.DEVICE_ID << 72) | (1 << 64) | random.getrandbits(64),
+                "delay": 0,
+                "next_data": None,
+            }
+            # Keep the slave end open so the master doesn't see hangups
+            self.slave_fds.append(slave)
+            self.ports.append(os.ttyname(slave))
+            self.states.append(state)
+            self.selector.register(master, selectors.EVENT_READ, state)
+        self.frame = bytearray(hm.MAX_FRAME_SIZE)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def send(self, state, message):
+        """
+        Send MESSAGE from the device with STATE.
+        """
+        size = message.send_into(self.frame)
+        os.write(state["fd"], self.frame[:size])
+
+    def respond(self, state, packet):
+        """
+        Respond to PACKET like a real device would.
+        """
+        message_type = packet.get_message_id()
+        if message_type == hm.MESSAGE_TYPES["SubscriptionRequest"]:
+            params_bitmask, state["delay"] = hm.struct.unpack("<HH", packet.get_payload())
+            state["next_data"] = time.monotonic() if params_bitmask and state["delay"] else None
+        elif message_type != hm.MESSAGE_TYPES["Ping"]:
+            return
+        params = ["natsuki"] if state["next_data"] is not None else []
+        self.send(state, hm.make_subscription_response(self.DEVICE_ID, params,
+                                                       state["delay"], state["uid"]))
+
+    def run(self):
+        """
+        Answer packets and stream data until stopped.
+        """
+        heartbeat = hm.HibikeMessage(hm.MESSAGE_TYPES["HeartBeatRequest"], [0])
+        next_heartbeat = time.monotonic()
+        while not self.stopped.is_set():
+            now = time.monotonic()
+            if now >= next_heartbeat:
+                for state in self.states:
+                    self.send(state, heartbeat)
+                next_heartbeat += self.HEARTBEAT_INTERVAL
+            deadlines = [state["next_data"] for state in self.states
+                         if state["next_data"] is not None]
+            deadlines.append(next_heartbeat)
+            for key, _ in self.selector.select(max(min(deadlines) - now, 0)):
+                state = key.data
+                try:
+                    state["decoder"].feed(os.read(state["fd"], 4096))
+                except OSError:
+                    continue
+                for packet in state["decoder"]:
+                    self.respond(state, packet)
+            now = time.monotonic()
+            for state in self.states:
+                if state["next_data"] is not None and now >= state["next_data"]:
+                    self.send(state, hm.make_device_data(
+                        self.DEVICE_ID, [("natsuki", time.monotonic_ns())]))
+                    state["next_data"] += state["delay"] / 1000
+
+    def close(self):
+        """
+        Stop the devices and close their terminals.
+        """
+        self.stopped.set()
+        self.thread.join()
+        for state in self.states:
+            os.close(state["fd"])
+        for slave in self.slave_fds:
+            os.close(slave)
+
+
+class SlowDevice(SimulatedDevices):
+    """
+    A single simulated ExampleDevice that reads what it's sent at READ_RATE
+    bytes per second, like a device on a slow serial line, and records
+    when it receives Disable packets in `disabled`.
+
+    It doesn't send heartbeats or data.
+    """
+    CHUNK_SIZE = 64
+
+    def __init__(self, read_rate):
+        super().__init__(1)
+        self.read_rate = read_rate
+        self.disabled = queue.Queue()
+
+    def respond(self, state, packet):
+        if packet.get_message_id() == hm.MESSAGE_TYPES["Disable"]:
+            self.disabled.put(time.monotonic())
+        super().respond(state, packet)
+
+    def run(self):
+        state = self.states[0]
+        while not self.stopped.is_set():
+            if not self.selector.select(0.1):
+                continue
+            try:
+                data = os.read(state["fd"], self.CHUNK_SIZE)
+            except OSError:
+                continue
+            state["decoder"].feed(data)
+            for packet in state["decoder"]:
+                self.respond(state, packet)
+            time.sleep(len(data) / self.read_rate)
+
+
+def process_cpu_seconds(pid):
+    """
+    The total user and system CPU time used by process PID so far.
+    """
+    with open("/proc/%d/stat" % pid) as stat_file:
+        # Skip past the process name, which may contain spaces
+        fields = stat_file.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def run_engine(engine, devices, args):
+    """
+    Run a hibike process using ENGINE against DEVICES, acting as the
+    state manager, and measure it.
+
+    Returns:
+        A tuple of (CPU seconds used, list of latencies in seconds).
+    """
+    state_queue = multiprocessing.Queue()
+    pipe_to_child, pipe_from_child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=hibike_process.hibike_process,
+                                      args=(multiprocessing.Queue(), state_queue, pipe_from_child),
+                                      kwargs={"engine": engine})
+    process.daemon = True
+    process.start()
+
+    subscribed = set()
+    last_values = {}
+    latencies = []
+    cpu_start = None
+    deadline = time.monotonic() + args.duration + hibike_process.IDENTIFY_TIMEOUT * 5
+    end = None
+    while time.monotonic() < (end or deadline):
+        try:
+            command, command_args = state_queue.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        if command == "device_subscribed":
+            uid, delay, _ = command_args
+            if delay == 0 and uid not in subscribed:
+                subscribed.add(uid)
+                pipe_to_child.send(["subscribe_device", [uid, args.delay, ["natsuki"]]])
+            if len(subscribed) == len(devices.states) and cpu_start is None:
+                # Everything is streaming; start measuring
+                cpu_start = process_cpu_seconds(process.pid)
+                end = time.monotonic() + args.duration
+        elif command == "device_values" and cpu_start is not None:
+            now = time.monotonic_ns()
+            for uid, params_and_values in command_args[0].items():
+                for param, value in params_and_values:
+                    if param == "natsuki" and value != last_values.get(uid):
+                        last_values[uid] = value
+                        latencies.append((now - value) / 1e9)
+    cpu_seconds = process_cpu_seconds(process.pid) - (cpu_start or 0)
+    process.terminate()
+    process.join()
+    if cpu_start is None:
+        print("%s: only %d of %d devices were found" % (engine, len(subscribed),
+                                                       len(devices.states)))
+    return cpu_seconds, latencies
+
+
+def bench_engines(args):
+    """
+    Compare the CPU usage and sensor-to-state-manager latency
+    of the hibike process engines.
+    """
+    print("%d devices streaming every %d ms, for %.0f s each"
+          % (args.devices, args.delay, args.duration))
+    print("%-10s %8s %10s %10s %10s %10s" % ("engine", "CPU %", "mean ms",
+                                             "p50 ms", "p95 ms", "max ms"))
+    for engine in args.engines or sorted(hibike_process.ENGINES):
+        devices = SimulatedDevices(args.devices)
+        devices.thread.start()
+        with tempfile.NamedTemporaryFile("w", suffix=".txt") as port_list:
+            port_list.write("\n".join(devices.ports))
+            port_list.flush()
+            hibike_process.VIRTUAL_DEVICE_CONFIG_FILE = port_list.name
+            # Don't remember the terminals as devices for next time
+            hibike_process.DEVICE_CACHE_FILE = ""
+            cpu_seconds, latencies = run_engine(engine, devices, args)
+        devices.close()
+        if not latencies:
+            continue
+        latencies.sort()
+        print("%-10s %8.1f %10.2f %10.2f %10.2f %10.2f" % (
+            engine, 100 * cpu_seconds / args.duration,
+            1000 * statistics.mean(latencies),
+            1000 * latencies[len(latencies) // 2],
+            1000 * latencies[int(len(latencies) * 0.95)],
+            1000 * latencies[-1]))
+
+
+def run_disable(engine, device, args):
+    """
+    Run a hibike process using ENGINE against DEVICE, flood it with
+    writes, and time how long a Disable sent in the middle of them takes
+    to reach the device.
+
+    Returns:
+        A list of latencies in seconds, one per trial.
+    """
+    state_queue = multiprocessing.Queue()
+    pipe_to_child, pipe_from_child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=hibike_process.hibike_process,
+                                      args=(multiprocessing.Queue(), state_queue, pipe_from_child),
+                                      kwargs={"engine": engine})
+    process.daemon = True
+    process.start()
+    uid = device.states[0]["uid"]
+    deadline = time.monotonic() + hibike_process.IDENTIFY_TIMEOUT * 5
+    while time.monotonic() < deadline:
+        try:
+            command, command_args = state_queue.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        if command == "device_subscribed" and command_args[0] == uid:
+            break
+    else:
+        print("%s: the device wasn't found" % engine)
+        process.terminate()
+        return []
+
+    latencies = []
+    for _ in range(args.trials):
+        # Reads in between writes stop them being merged, so they pile up
+        flood_end = time.monotonic() + args.flood
+        value = 0
+        while time.monotonic() < flood_end:
+            value += 1
+            pipe_to_child.send(["write_params", [uid, [("yuko", value), ("aoi", value)]]])
+            pipe_to_child.send(["read_params", [uid, ["yuko"]]])
+        start = time.monotonic()
+        pipe_to_child.send(["disable_all", []])
+        try:
+            latencies.append(device.disabled.get(timeout=30) - start)
+        except queue.Empty:
+            print("%s: the Disable never arrived" % engine)
+            break
+        # Let the backlog drain before the next trial
+        time.sleep(args.flood * 2)
+    process.terminate()
+    process.join()
+    return latencies
+
+
+def bench_disable(args):
+    """
+    Measure how long a Disable takes to reach a device on a serial line
+    that's saturated with writes, for each hibike process engine.
+    """
+    print("device reading %d bytes/s, flooded for %.1f s before each Disable"
+          % (args.read_rate, args.flood))
+    print("%-10s %10s %10s %10s" % ("engine", "mean ms", "min ms", "max ms"))
+    for engine in args.engines or sorted(hibike_process.ENGINES):
+        device = SlowDevice(args.read_rate)
+        device.thread.start()
+        with tempfile.NamedTemporaryFile("w", suffix=".txt") as port_list:
+            port_list.write("\n".join(device.ports))
+            port_list.flush()
+            hibike_process.VIRTUAL_DEVICE_CONFIG_FILE = port_list.name
+            hibike_process.DEVICE_CACHE_FILE = ""
+            latencies = run_disable(engine, device, args)
+        device.close()
+        if not latencies:
+            continue
+        print("%-10s %10.2f %10.2f %10.2f" % (
+            engine, 1000 * statistics.mean(latencies),
+            1000 * min(latencies), 1000 * max(latencies)))
+
+
+BENCHMARKS = {
+    "checksum": bench_checksum,
+    "cobs": bench_cobs,
+    "send": bench_send,
+    "engines": bench_engines,
+    "disable": bench_disable,
+}
+
+
+def main():
+    """
+    Run the benchmarks named on the command line.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmarks", nargs="*",
+                        help="benchmarks to run, out of %s (default: all)"
+                        % ", ".join(sorted(BENCHMARKS)))
+    parser.add_argument("-n", "--number", type=int, default=20000,
+                        help="iterations per measurement")
+    parser.add_argument("--devices", type=int, default=10,
+                        help="number of simulated devices (engines)")
+    parser.add_argument("--delay", type=int, default=10,
+                        help="subscription delay in milliseconds (engines)")
+    parser.add_argument("--duration", type=float, default=10,
+                        help="seconds to measure each engine for (engines)")
+    parser.add_argument("--read-rate", type=int, default=11520,
+                        help="bytes per second the simulated device reads (disable)")
+    parser.add_argument("--flood", type=float, default=0.5,
+                        help="seconds to send writes for before each Disable (disable)")
+    parser.add_argument("--trials", type=int, default=5,
+                        help="Disables to time per engine (disable)")
+    parser.add_argument("--engine", dest="engines", action="append",
+                        choices=sorted(hibike_process.ENGINES),
+                        help="engine to measure; may be repeated (default: all)")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark: %s" % name)
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        BENCHMARKS[name](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""
+Pieces shared by both hibike engines: the queue of instructions waiting
+for each device, and closing the ports of devices that have gone away.
+"""
+from collections import deque
+import os
+import queue
+import termios
+import threading
+import time
+
+__all__ = ["InstructionLanes", "PortCloser", "discard_output", "force_close"]
+
+
+# The order instructions waiting for a device are sent in, most urgent first.
+# Instructions of the same priority are sent in the order they were given.
+INSTRUCTION_PRIORITIES = {
+    "stop": 0,
+    "disable": 0,
+    "heartResp": 0,
+    "write": 1,
+    "read": 1,
+    "subscribe": 2,
+    "ping": 2,
+}
+# Time in seconds after which writing a param the value it was last written is
+# sent to the device again; until then, such writes are dropped. Shorter than
+# runtime's own interval (RUNTIME_CONFIG.STUDENT_WRITE_REFRESH), so the writes
+# runtime repeats to refresh values always get through.
+WRITE_REFRESH_INTERVAL = float(os.environ.get("HIBIKE_WRITE_REFRESH_INTERVAL", .5))
+# Number of threads closing the ports of devices that have gone away
+CLEAN_UP_WORKERS = 4
+# Time in seconds a device's threads get to stop, once it's been removed, before
+# its port is closed anyway. Closes taking longer than this are reported.
+CLEAN_UP_TIMEOUT = 1
+# Time in seconds between reports of how long ports took to close, when any
+# were closed in between. Set HIBIKE_CLEAN_UP_REPORT_INTERVAL to 0 to turn
+# these off.
+CLEAN_UP_REPORT_INTERVAL = float(os.environ.get("HIBIKE_CLEAN_UP_REPORT_INTERVAL", 60))
+
+
+class InstructionLanes:
+    """
+    Instructions waiting to be sent to a device, in a separate queue for
+    each priority in INSTRUCTION_PRIORITIES, so urgent ones (like disable)
+    go out first however many others are waiting.
+
+    A write right after another write to the same device is merged into it,
+    keeping the last value written to each parameter, so a burst of writes
+    goes out as one DeviceWrite packet. Writes still waiting when a disable
+    is added are dropped, so they can't undo it by going out after it.
+
+    Writing a parameter the value it was last written is left out, unless
+    that was at least WRITE_REFRESH_INTERVAL seconds ago or the device has
+    been disabled since, so a device that is sent the same values over and
+    over only gets them every so often.
+    """
+    def __init__(self):
+        self.lanes = [deque() for _ in range(max(INSTRUCTION_PRIORITIES.values()) + 1)]
+        # Param: (value, `time.monotonic` time), for the last value written to each
+        self.written = {}
+
+    def __len__(self):
+        return sum(len(lane) for lane in self.lanes)
+
+    def append(self, instruction_and_args):
+        """
+        Add an (instruction, args) tuple.
+        """
+        instruction, args = instruction_and_args
+        lane = self.lanes[INSTRUCTION_PRIORITIES[instruction]]
+        if instruction == "disable":
+            writes = self.lanes[INSTRUCTION_PRIORITIES["write"]]
+            kept = [item for item in writes if item[0] != "write"]
+            writes.clear()
+            writes.extend(kept)
+            self.written.clear()
+        elif instruction == "write":
+            uid, params_and_values = args
+            params_and_values = self._changed(params_and_values)
+            if not params_and_values:
+                return
+            if lane and lane[-1][0] == "write" and lane[-1][1][0] == uid:
+                lane[-1][1][1].update(params_and_values)
+                return
+            args = (uid, params_and_values)
+        lane.append((instruction, args))
+
+    def _changed(self, params_and_values):
+        """
+        Pick out the PARAMS_AND_VALUES that need writing, and note that
+        they have been.
+
+        Returns:
+            A dict of param: value.
+        """
+        now = time.monotonic()
+        changed = {}
+        for param, value in dict(params_and_values).items():
+            last = self.written.get(param)
+            if (last is not None and last[0] == value and type(last[0]) is type(value)
+                    and now - last[1] < WRITE_REFRESH_INTERVAL):
+                continue
+            self.written[param] = (value, now)
+            changed[param] = value
+        return changed
+
+    def pop(self):
+        """
+        Remove the most urgent instruction.
+
+        Returns:
+            An (instruction, args) tuple.
+        Raises:
+            IndexError if there aren't any.
+        """
+        for lane in self.lanes:
+            if lane:
+                return lane.popleft()
+        raise IndexError("no instructions waiting")
+
+
+class PortCloser:
+    """
+    Close the serial ports of devices that have gone away, once the
+    threads that were using them have stopped, on a pool of background
+    threads.
+
+    Closing a serial port can take a very long time (30 seconds or more),
+    since the kernel waits for output the device hasn't read to drain. So
+    that output is thrown away first (see `force_close`), and several
+    ports are closed at once, so one slow close doesn't hold up the rest.
+    Threads that don't stop within TIMEOUT don't hold up their port's
+    close either.
+
+    Every REPORT_INTERVAL seconds in which ports were closed, how long
+    they took is printed (see `stats`).
+    """
+    def __init__(self, workers=CLEAN_UP_WORKERS, timeout=CLEAN_UP_TIMEOUT,
+                 report_interval=CLEAN_UP_REPORT_INTERVAL):
+        self.timeout = timeout
+        self.report_interval = report_interval
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        # Number of ports closed, and the total and longest times in seconds
+        # from being handed over to being closed with their threads finished
+        self.closed = 0
+        self.total_reclaim_time = 0
+        self.max_reclaim_time = 0
+        # Number of ports whose threads were still running after TIMEOUT
+        self.timed_out = 0
+        for _ in range(workers):
+            worker = threading.Thread(target=self.run)
+            worker.daemon = True
+            worker.start()
+        if report_interval > 0:
+            reporter = threading.Thread(target=self.report)
+            reporter.daemon = True
+            reporter.start()
+
+    def close(self, serial_port, threads=()):
+        """
+        Close SERIAL_PORT in the background, after waiting for THREADS,
+        which were using it and have been told to stop, to finish.
+        """
+        self.queue.put((time.time(), serial_port, threads))
+
+    def run(self):
+        """
+        Close ports as they're handed over, forever.
+        """
+        while True:
+            queued, serial_port, threads = self.queue.get()
+            start = time.time()
+            try:
+                # Wake up threads blocked on the port, so they see they've been stopped
+                serial_port.cancel_read()
+                serial_port.cancel_write()
+            except OSError:
+                pass
+            for thread in threads:
+                thread.join(max(start + self.timeout - time.time(), 0))
+            timed_out = any(thread.is_alive() for thread in threads)
+            force_close(serial_port)
+            reclaim_time = time.time() - queued
+            with self.lock:
+                self.closed += 1
+                self.total_reclaim_time += reclaim_time
+                self.max_reclaim_time = max(self.max_reclaim_time, reclaim_time)
+                self.timed_out += timed_out
+            if timed_out or reclaim_time > self.timeout:
+                print("Took %.1f s to close %s%s" % (reclaim_time, serial_port.name,
+                                                     " (threads still running)"
+                                                     if timed_out else ""))
+
+    def stats(self):
+        """
+        Returns:
+            A dict of the number of ports waiting to be closed and closed so
+            far, the mean and longest times in seconds it took to close
+            them, and how many were still in use after the timeout.
+        """
+        with self.lock:
+            return {
+                "waiting": self.queue.qsize(),
+                "closed": self.closed,
+                "mean_reclaim_time": self.total_reclaim_time / max(self.closed, 1),
+                "max_reclaim_time": self.max_reclaim_time,
+                "timed_out": self.timed_out,
+            }
+
+    def report(self):
+        """
+        Print `stats` every REPORT_INTERVAL seconds in which ports were
+        closed, forever.
+        """
+        reported = 0
+        while True:
+            time.sleep(self.report_interval)
+            stats = self.stats()
+            if stats["closed"] == reported:
+                continue
+            reported = stats["closed"]
+            print("Closed %d ports (%d waiting): %.2f s mean, %.2f s max to close, "
+                  "%d with threads still running" % (
+                      stats["closed"], stats["waiting"], stats["mean_reclaim_time"],
+                      stats["max_reclaim_time"], stats["timed_out"]))
+
+
+def discard_output(serial_port):
+    """
+    Throw away output to SERIAL_PORT that's still waiting in the kernel,
+    so that whatever is written next goes out straight away.
+
+    The device may be left with part of a packet; packets written after
+    this should start with an extra delimiter, so it can find the start
+    of the next one.
+    """
+    try:
+        if serial_port.fd is not None:
+            termios.tcflush(serial_port.fd, termios.TCOFLUSH)
+    except (termios.error, OSError):
+        # Probably already gone
+        pass
+
+
+def force_close(serial_port):
+    """
+    Close SERIAL_PORT without waiting for unsent output to drain.
+    """
+    discard_output(serial_port)
+    try:
+        serial_port.close()
+    except OSError:
+        # The file descriptor is released even if closing it fails
+        pass
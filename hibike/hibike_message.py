@@ -3,10 +3,19 @@ Functions and classes for dealing with Hibike packets.
 """
 from __future__ import print_function
 # Rewritten because Python.__version__ != 3
+from collections import namedtuple
+import functools
+import operator
 import struct
 import os
 import json
 
+try:
+    # Optional C implementation of COBS (`pip install cobs`)
+    from cobs import cobs as _cobs
+except ImportError:
+    _cobs = None
+
 CONFIG_FILE = open(os.path.join(
     os.path.dirname(__file__), 'hibikeDevices.json'), 'r')
 DEVICES = json.load(CONFIG_FILE)
@@ -66,16 +75,43 @@ ERROR_CODES = {
 }
 
 
+# Set of valid message ids, for fast membership checks
+MESSAGE_IDS = frozenset(MESSAGE_TYPES.values())
+
+# The largest possible packet on the wire: a zero byte, the size
+# of the encoded message, and up to 255 bytes of encoded message
+MAX_FRAME_SIZE = 257
+
+# What parsing a packet raises when its payload doesn't make sense
+# (e.g. doesn't match the params it says it has), even though its
+# checksum was right
+PAYLOAD_ERRORS = (struct.error, AssertionError, KeyError, IndexError, ValueError)
+
+
 class HibikeMessage:
     """
     An Hibike packet.
     """
+    __slots__ = ("_message_id", "_payload", "_length")
+
     def __init__(self, message_id, payload):
-        assert message_id in MESSAGE_TYPES.values()
+        assert message_id in MESSAGE_IDS
         self._message_id = message_id
+        # Slicing a memoryview (e.g. from a FrameDecoder) does not copy
         self._payload = payload[:]
         self._length = len(payload)
 
+    def reset(self, message_id, payload):
+        """
+        Reuse this message for MESSAGE_ID and PAYLOAD.
+
+        Unlike the constructor, PAYLOAD is used as-is rather than copied.
+        """
+        assert message_id in MESSAGE_IDS
+        self._message_id = message_id
+        self._payload = payload
+        self._length = len(payload)
+
     def get_message_id(self):
         """
         Get the message ID.
@@ -85,6 +121,9 @@ class HibikeMessage:
     def get_payload(self):
         """
         Get a copy of the payload as a bytearray.
+
+        If the message was built around a memoryview, a view of the same
+        memory is returned instead.
         """
         return self._payload[:]
 
@@ -98,6 +137,43 @@ class HibikeMessage:
         m_buff.extend(self.get_payload())
         return m_buff
 
+    def send_into(self, buffer):
+        """
+        Write this message into BUFFER as a complete packet, ready to go
+        out on the wire: framing, checksum and COBS encoding included.
+
+        BUFFER must be a bytearray of at least MAX_FRAME_SIZE bytes, and
+        can be reused between messages.
+
+        Returns:
+            The number of bytes of BUFFER that make up the packet.
+        """
+        # Lay out the message three bytes in, behind the zero byte, the size
+        # byte and the first COBS code byte, and then encode it in place
+        message_end = 5 + self._length
+        frame_end = message_end + 1
+        # Encoding adds one byte, which has to leave the size within a byte.
+        # This also rules out runs of 254 nonzero bytes in the middle of
+        # the message, so every code byte just points at the next zero.
+        if frame_end - 2 > 0xFF:
+            raise HibikeMessageException("Message too long to send: %d bytes"
+                                         % (frame_end - 3))
+        buffer[3] = self._message_id
+        buffer[4] = self._length
+        buffer[5:message_end] = self._payload
+        buffer[message_end] = checksum(memoryview(buffer)[3:message_end])
+
+        last_code = 2
+        zero = buffer.find(0, 3, frame_end)
+        while zero != -1:
+            buffer[last_code] = zero - last_code
+            last_code = zero
+            zero = buffer.find(0, zero + 1, frame_end)
+        buffer[last_code] = frame_end - last_code
+        buffer[0] = 0
+        buffer[1] = frame_end - 2
+        return frame_end
+
     def __str__(self):
         return str([self._message_id] + [self._length] + list(self._payload))
 
@@ -129,27 +205,33 @@ def get_id(uid):
 
 def checksum(data):
     """
-    Compute a checksum for DATA.
-    """
-    # Remove this later after development
-    assert isinstance(data, bytearray), "data must be a bytearray"
+    Compute a checksum for DATA, which can be any bytes-like object.
 
-    chk = data[0]
-    for i in range(1, len(data)):
-        chk ^= data[i]
-    return chk
+    The checksum is the XOR of every byte in DATA.
+    """
+    if len(data) < 32:
+        return functools.reduce(operator.xor, data, 0)
+    # For longer buffers, treat DATA as one big integer and repeatedly
+    # XOR its top half onto its bottom half until a single byte is left
+    folded = int.from_bytes(data, "little")
+    shift = 4 << (len(data) - 1).bit_length()
+    while shift >= 8:
+        folded ^= folded >> shift
+        shift >>= 1
+    return folded & 0xFF
 
 
-def send(serial_conn, message):
+def send(serial_conn, message, buffer=None):
     """
     Send MESSAGE over SERIAL_CONN.
+
+    If BUFFER is given, it is used to build the packet instead of
+    allocating a new one; see `HibikeMessage.send_into`.
     """
-    m_buff = message.to_bytes()
-    chk = checksum(m_buff)
-    m_buff.append(chk)
-    encoded = cobs_encode(m_buff)
-    out_buf = bytearray([0x00, len(encoded)]) + encoded
-    serial_conn.write(out_buf)
+    if buffer is None:
+        buffer = bytearray(MAX_FRAME_SIZE)
+    size = message.send_into(buffer)
+    serial_conn.write(memoryview(buffer)[:size])
 
 
 def encode_params(device_id, params):
@@ -204,6 +286,61 @@ def format_string(device_id, params):
     return type_string
 
 
+# A precompiled layout for one set of parameters of a device type.
+#   params - tuple of parameter names, in bitmask order
+#   struct - a `struct.Struct` for the params bitmask followed by the values
+ParamCodec = namedtuple("ParamCodec", ["params", "struct"])
+
+# Cache of (device_id, params_bitmask): ParamCodec
+_PARAM_CODECS = {}
+
+
+def get_param_codec(device_id, params_bitmask):
+    """
+    Get the ParamCodec for PARAMS_BITMASK on DEVICE_ID.
+
+    Codecs are built the first time a (device_id, params_bitmask) pair is
+    seen and cached afterwards, so decoding and encoding a packet costs
+    a dictionary lookup instead of rebuilding a format string.
+    """
+    key = (device_id, params_bitmask)
+    try:
+        return _PARAM_CODECS[key]
+    except KeyError:
+        params = tuple(decode_params(device_id, params_bitmask))
+        codec = ParamCodec(params, struct.Struct("<H" + format_string(device_id, params)))
+        _PARAM_CODECS[key] = codec
+        return codec
+
+
+def pack_params(device_id, params_and_values):
+    """
+    Pack PARAMS_AND_VALUES into a bitmask-prefixed payload.
+
+    Values are laid out in parameter number order, regardless
+    of the order of PARAMS_AND_VALUES.
+    """
+    values = dict(params_and_values)
+    params_bitmask = encode_params(device_id, values)
+    codec = get_param_codec(device_id, params_bitmask)
+    payload = bytearray(codec.struct.size)
+    codec.struct.pack_into(payload, 0, params_bitmask,
+                           *[values[param] for param in codec.params])
+    return payload
+
+
+def unpack_params(device_id, payload):
+    """
+    Unpack a bitmask-prefixed PAYLOAD into a list of (param, value) tuples.
+    """
+    params_bitmask, = struct.unpack_from("<H", payload)
+    codec = get_param_codec(device_id, params_bitmask)
+    if len(payload) != codec.struct.size:
+        raise struct.error("unpack requires a buffer of %d bytes" % codec.struct.size)
+    values = codec.struct.unpack_from(payload)
+    return list(zip(codec.params, values[1:]))
+
+
 def make_ping():
     """ Makes and returns Ping message."""
     payload = bytearray()
@@ -295,15 +432,7 @@ def make_device_write(device_id, params_and_values):
         device_id         - a device type id (not uid).
         params_and_values - an iterable of param (name, value) tuples
     """
-    params_and_values = sorted(
-        params_and_values, key=lambda x: PARAM_MAP[device_id][x[0]][0])
-    params = [param[0] for param in params_and_values]
-    params_bitmask = encode_params(device_id, params)
-    values = [param[1] for param in params_and_values]
-
-    type_string = '<H' + format_string(device_id, params)
-    temp_payload = struct.pack(type_string, params_bitmask, *values)
-    payload = bytearray(temp_payload)
+    payload = pack_params(device_id, params_and_values)
     message = HibikeMessage(MESSAGE_TYPES["DeviceWrite"], payload)
     return message
 
@@ -319,15 +448,7 @@ def make_device_data(device_id, params_and_values):
         device_id         - a device type id (not uid).
         params_and_values - an iterable of param (name, value) tuples
     """
-    params = [param_tuple[0] for param_tuple in params_and_values]
-    params_bitmask = encode_params(device_id, params)
-    values = [param_tuple[1] for param_tuple in params_and_values]
-
-    type_string = '<H' + format_string(device_id, params)
-
-    temp_payload = struct.pack(type_string, params_bitmask, *values)
-    payload = bytearray(temp_payload)
-
+    payload = pack_params(device_id, params_and_values)
     message = HibikeMessage(MESSAGE_TYPES["DeviceData"], payload)
     return message
 
@@ -360,11 +481,7 @@ def decode_device_write(msg, device_id):
     assert msg.get_message_id() == MESSAGE_TYPES["DeviceWrite"]
     payload = msg.get_payload()
     assert len(payload) >= 2
-    params, = struct.unpack("<H", payload[:2])
-    params = decode_params(device_id, params)
-    struct_format = "<" + format_string(device_id, params)
-    values = struct.unpack(struct_format, payload[2:])
-    return list(zip(params, values))
+    return unpack_params(device_id, payload)
 
 
 def parse_device_data(msg, device_id):
@@ -374,11 +491,7 @@ def parse_device_data(msg, device_id):
     assert msg.get_message_id() == MESSAGE_TYPES["DeviceData"]
     payload = msg.get_payload()
     assert len(payload) >= 2
-    params, = struct.unpack("<H", payload[:2])
-    params = decode_params(device_id, params)
-    struct_format = "<" + format_string(device_id, params)
-    values = struct.unpack(struct_format, payload[2:])
-    return list(zip(params, values))
+    return unpack_params(device_id, payload)
 
 
 def parse_bytes(msg_bytes):
@@ -405,41 +518,151 @@ def parse_bytes(msg_bytes):
     return HibikeMessage(message_id, payload)
 
 
-def blocking_read_generator(serial_conn, stop_event=None):
+class FrameDecoder:
     """
-    Yield packets from SERIAL_CONN, stopping if STOP_EVENT exists
-    and is set.
+    Incrementally decode Hibike packets from a stream of bytes.
+
+    Received bytes are appended to a single buffer that is consumed by
+    moving a read offset rather than by slicing, and packets are
+    COBS-decoded in place. The payloads of the messages returned are
+    memoryviews into that buffer, and the same HibikeMessage object is
+    reused for every packet, so a message is only valid until the next
+    one is decoded or the decoder is fed again; copy anything that needs
+    to be kept around.
     """
-    zero_byte = bytes([0])
-    packets_buffer = bytearray()
-    while stop_event is None or not stop_event.is_set():
+    def __init__(self, size=4096):
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        self._message = None
 
-        # Wait for a 0 byte to appear
-        while packets_buffer.find(zero_byte) == -1:
-            new_bytes = serial_conn.read(max(1, serial_conn.inWaiting()))
-            packets_buffer.extend(new_bytes)
+    def feed(self, data):
+        """
+        Append DATA to the end of the buffer.
+        """
+        size = len(data)
+        if self._end + size > len(self._buffer):
+            self._make_room(size)
+        self._view[self._end:self._end + size] = data
+        self._end += size
 
-        # Truncate incomplete packets at start of buffer
-        packets_buffer = packets_buffer[packets_buffer.find(zero_byte):]
+    def _make_room(self, size):
+        """
+        Move unread bytes to the front of the buffer, growing it if
+        there still isn't space for SIZE more bytes.
+        """
+        pending = self._end - self._start
+        if pending + size > len(self._buffer):
+            # Outstanding payload views keep the old buffer alive,
+            # so we can't resize it in place
+            new_buffer = bytearray(max(2 * len(self._buffer), pending + size))
+            new_buffer[:pending] = self._view[self._start:self._end]
+            self._buffer = new_buffer
+            self._view = memoryview(new_buffer)
+        else:
+            self._view[:pending] = self._view[self._start:self._end]
+        self._start = 0
+        self._end = pending
 
-        # Attempt to parse a packet
-        packet = parse_bytes(packets_buffer)
+    def next_message(self):
+        """
+        Decode the next packet in the buffer.
 
-        if packet != None:
-            # Chop off a byte so we don't output this packet again
-            packets_buffer = packets_buffer[1:]
-            yield packet
+        Returns:
+            A HibikeMessage, or None if no complete packet has been received.
+        """
+        buf = self._buffer
+        while True:
+            start = buf.find(0, self._start, self._end)
+            if start == -1:
+                # Nothing we have can be part of a packet
+                self._start = self._end
+                return None
+            self._start = start
+            if self._end - start < 2:
+                return None
+            frame_end = start + 2 + buf[start + 1]
+            # A zero byte is never part of an encoded packet, so if there's
+            # one before the end of this packet, the packet got truncated
+            next_start = buf.find(0, start + 1, min(frame_end, self._end))
+            if next_start != -1:
+                self._start = next_start
+                continue
+            if frame_end > self._end:
+                return None
+            self._start = frame_end
+            message = self._decode_frame(start + 2, frame_end)
+            if message is not None:
+                return message
+
+    def _decode_frame(self, frame_start, frame_end):
+        """
+        COBS-decode the packet between FRAME_START and FRAME_END in place,
+        and turn it into a HibikeMessage.
+
+        Returns:
+            A HibikeMessage, or None if the packet is invalid.
+        """
+        buf = self._buffer
+        view = self._view
+        overhead = cobs_unstuff(view[frame_start:frame_end])
+        if overhead is None:
+            return None
+        if len(overhead) == 1:
+            # Only the leading code byte needs to go
+            start = frame_start + 1
+            end = frame_end
+        else:
+            # Squeeze out the leftover code bytes
+            start = end = frame_start
+            bounds = overhead + [frame_end - frame_start]
+            for index, next_index in zip(bounds, bounds[1:]):
+                segment_size = next_index - index - 1
+                view[end:end + segment_size] = view[frame_start + index + 1:
+                                                    frame_start + next_index]
+                end += segment_size
+
+        if end - start < 2:
+            return None
+        message_id = buf[start]
+        payload_start = start + 2
+        payload_end = payload_start + buf[start + 1]
+        if end < payload_end + 1:
+            return None
+        if buf[payload_end] != checksum(view[start:end - 1]):
+            return None
+        payload = view[payload_start:payload_end]
+        if self._message is None:
+            self._message = HibikeMessage(message_id, payload)
+        else:
+            self._message.reset(message_id, payload)
+        return self._message
+
+    def __iter__(self):
+        """
+        Yield every complete packet currently in the buffer.
+        """
+        message = self.next_message()
+        while message is not None:
+            yield message
+            message = self.next_message()
+
+
+def blocking_read_generator(serial_conn, stop_event=None):
+    """
+    Yield packets from SERIAL_CONN, stopping if STOP_EVENT exists
+    and is set.
+
+    Each packet is only valid until the next one is requested.
+    """
+    decoder = FrameDecoder()
+    while stop_event is None or not stop_event.is_set():
+        packet = decoder.next_message()
+        if packet is None:
+            decoder.feed(serial_conn.read(max(1, serial_conn.inWaiting())))
         else:
-            # If there's another packet in the buffer
-            # we can safely jump to it for the next iteration
-            if packets_buffer.count(zero_byte) > 1:
-                new_packet = packets_buffer[1:].find(zero_byte) + 1
-                packets_buffer = packets_buffer[new_packet:]
-            # Otherwise, there might be more incoming bytes for the current packet,
-            # so we do a blocking read and try again
-            else:
-                new_bytes = serial_conn.read(max(1, serial_conn.inWaiting()))
-                packets_buffer.extend(new_bytes)
+            yield packet
 
 
 def blocking_read(serial_conn):
@@ -528,39 +751,66 @@ def cobs_encode(data):
     """
     COBS-encode DATA.
     """
+    if _cobs is not None:
+        return bytearray(_cobs.encode(bytes(data)))
     output = bytearray()
-    curr_block = bytearray()
-    for byte in data:
-        if byte:
-            curr_block.append(byte)
-            if len(curr_block) == 254:
-                output.append(1 + len(curr_block))
-                output.extend(curr_block)
-                curr_block = bytearray()
-        else:
-            output.append(1 + len(curr_block))
-            output.extend(curr_block)
-            curr_block = bytearray()
-    output.append(1 + len(curr_block))
-    output.extend(curr_block)
+    # Every zero becomes a code byte, so the blocks are exactly the runs between zeros
+    for block in bytes(data).split(b"\x00"):
+        while len(block) >= 254:
+            output.append(0xFF)
+            output += block[:254]
+            block = block[254:]
+        output.append(len(block) + 1)
+        output += block
     return output
 
 
+def cobs_unstuff(data):
+    """
+    Overwrite the code bytes in COBS-encoded DATA, a writable buffer,
+    with the zeros they stand for.
+
+    Returns:
+        A list of the indices of code bytes that don't stand for a zero
+        (the first byte, and any byte following a full block), which
+        have to be removed to finish decoding, or None if DATA isn't
+        validly encoded.
+    """
+    size = len(data)
+    overhead = [0]
+    index = 0
+    code = data[0] if size else 1
+    while True:
+        block_end = index + code
+        if code == 0 or block_end > size:
+            return None
+        if block_end == size:
+            return overhead
+        # Read the next code byte before it gets overwritten
+        next_code = data[block_end]
+        if code == 0xFF:
+            overhead.append(block_end)
+        else:
+            data[block_end] = 0
+        index = block_end
+        code = next_code
+
+
 def cobs_decode(data):
     """
     Decode COBS-encoded DATA.
     """
-    output = bytearray()
-    index = 0
-    while index < len(data):
-        block_size = data[index] - 1
-        index += 1
-        if index + block_size > len(data):
+    if _cobs is not None:
+        try:
+            return bytearray(_cobs.decode(bytes(data)))
+        except _cobs.DecodeError:
             return bytearray()
-        output.extend(data[index:index + block_size])
-        index += block_size
-        if block_size + 1 < 255 and index < len(data):
-            output.append(0)
+    output = bytearray(data)
+    overhead = cobs_unstuff(output)
+    if overhead is None:
+        return bytearray()
+    for index in reversed(overhead):
+        del output[index]
     return output
 
 
@@ -3,6 +3,7 @@ The main Hibike process.
 """
 from collections import namedtuple
 import glob
+import json
 import multiprocessing
 import os
 import queue
@@ -13,17 +14,42 @@ import time
 # pylint: disable=import-error
 import hibike_message as hm
 import serial
+from device_helpers import InstructionLanes, PortCloser, discard_output
+from port_watcher import PortWatcher
 
-__all__ = ["hibike_process"]
+__all__ = ["hibike_process", "threaded_hibike_process", "selector_hibike_process"]
 
 
-# .04 milliseconds sleep is the same frequency we subscribe to devices at
-BATCH_SLEEP_TIME = .04
+# Minimum time in seconds between sending device values to the state manager.
+# Changed values are sent as soon as they arrive, unless values were sent less
+# than this long ago, in which case they're held back and sent together.
+PUBLISH_MIN_INTERVAL = float(os.environ.get("HIBIKE_PUBLISH_INTERVAL", .01))
 # Time in seconds to wait until reading from a potential sensor
 IDENTIFY_TIMEOUT = 1
-# Time in seconds to wait between checking for new devices
-# and cleaning up old ones.
+# Time in seconds between pings to a potential sensor that hasn't answered yet
+IDENTIFY_RETRY_INTERVAL = .1
+# Time in seconds between cleaning up old devices, and between checking
+# for new ones when ports can't be watched for changes (see PortWatcher)
 HOTPLUG_POLL_INTERVAL = 1
+# Time in seconds between trying again with ports that didn't have a smart
+# sensor on them (e.g. because it was still starting up)
+HOTPLUG_RESCAN_INTERVAL = 10
+# Serial ports that smart sensors can turn up on.
+# Last pattern is included so that it's compatible with OS X Sierra
+# Note: If you are running OS X Sierra, do not access the directory through vagrant ssh
+# Instead access it through Volumes/vagrant/PieCentral
+SERIAL_PORT_PATTERNS = ["/dev/ttyACM*", "/dev/ttyUSB*", "/dev/tty.usbmodem*"]
+# File listing extra (e.g. virtual) serial ports to use, one per line
+VIRTUAL_DEVICE_CONFIG_FILE = os.path.join(os.path.dirname(__file__), "virtual_devices.txt")
+# File remembering which port each device was on, so that next time they
+# can be brought up straight away instead of after identifying every port.
+# Set HIBIKE_DEVICE_CACHE to an empty string to turn this off.
+DEVICE_CACHE_FILE = os.environ.get("HIBIKE_DEVICE_CACHE",
+                                   os.path.join(os.path.dirname(__file__), "device_cache.json"))
+# Which implementation of the hibike process to run, out of ENGINES:
+#   "threads"  - a read thread and a write thread for every device
+#   "selector" - every serial port handled by one non-blocking event loop
+DEFAULT_ENGINE = os.environ.get("HIBIKE_ENGINE", "threads")
 
 
 def get_working_serial_ports(excludes=()):
@@ -33,19 +59,46 @@ def get_working_serial_ports(excludes=()):
     Returns:
         A list of serial port objects (`serial.Serial`) and port names.
     """
-    excludes = set(excludes)
-    # Last command is included so that it's compatible with OS X Sierra
-    # Note: If you are running OS X Sierra, do not access the directory through vagrant ssh
-    # Instead access it through Volumes/vagrant/PieCentral
-    ports = set(glob.glob("/dev/ttyACM*") + glob.glob("/dev/ttyUSB*")
-                + glob.glob("/dev/tty.usbmodem*"))
-    ports.difference_update(excludes)
+    return open_serial_ports(list_serial_ports() - set(excludes))
+
+
+def list_serial_ports():
+    """
+    List the ports matching SERIAL_PORT_PATTERNS, and the virtual ports
+    in VIRTUAL_DEVICE_CONFIG_FILE.
+
+    Returns:
+        A set of serial port names.
+    """
+    ports = set()
+    for pattern in SERIAL_PORT_PATTERNS:
+        ports.update(glob.glob(pattern))
     try:
-        virtual_device_config_file = os.path.join(os.path.dirname(__file__), "virtual_devices.txt")
-        ports.update(open(virtual_device_config_file, "r").read().split())
+        ports.update(open(VIRTUAL_DEVICE_CONFIG_FILE, "r").read().split())
     except IOError:
         pass
+    return ports
+
+
+def make_port_watcher():
+    """
+    Start watching for serial ports appearing and disappearing.
 
+    Returns:
+        A `PortWatcher` for the ports in `list_serial_ports`.
+    """
+    directories = {os.path.dirname(pattern) for pattern in SERIAL_PORT_PATTERNS}
+    directories.add(os.path.dirname(os.path.abspath(VIRTUAL_DEVICE_CONFIG_FILE)))
+    return PortWatcher(list_serial_ports, directories, HOTPLUG_POLL_INTERVAL)
+
+
+def open_serial_ports(ports):
+    """
+    Open the serial ports named in PORTS.
+
+    Returns:
+        A list of serial port objects (`serial.Serial`) and port names.
+    """
     serials = []
     port_names = []
     for port in ports:
@@ -57,11 +110,85 @@ def get_working_serial_ports(excludes=()):
     return serials, port_names
 
 
+def get_port_ids():
+    """
+    Map the real paths of serial ports to their names in /dev/serial/by-id,
+    which are based on the USB device (including its serial number)
+    rather than the order devices were plugged in.
+    """
+    return {os.path.realpath(path): path for path in glob.glob("/dev/serial/by-id/*")}
+
+
+def load_device_cache():
+    """
+    Read which port each device was on last time from DEVICE_CACHE_FILE.
+
+    Ports with a name in /dev/serial/by-id are looked up by that name, in
+    case the device came back on a different port. Nothing is sent to the
+    devices, so the UIDs still need checking.
+
+    Entries that can't be made sense of are skipped, and a file that can't
+    be read at all is treated as if there were no cache.
+
+    Returns:
+        A map of serial port names to UIDs.
+    """
+    if not DEVICE_CACHE_FILE:
+        return {}
+    try:
+        with open(DEVICE_CACHE_FILE, "r") as cache_file:
+            entries = json.load(cache_file)
+    except (IOError, ValueError):
+        return {}
+    if not isinstance(entries, list):
+        return {}
+    port_ids = get_port_ids()
+    cached = {}
+    for entry in entries:
+        try:
+            port, port_id, uid = entry["port"], entry["id"], entry["uid"]
+            if not isinstance(port, str) or not isinstance(uid, int):
+                continue
+            if port_id is not None:
+                port = os.path.realpath(port_id)
+                if port_ids.get(port) != port_id:
+                    # That USB device isn't plugged in
+                    continue
+            elif not os.path.exists(port):
+                continue
+        except (KeyError, TypeError, ValueError):
+            continue
+        cached[port] = uid
+    return cached
+
+
+def save_device_cache(device_ports):
+    """
+    Write DEVICE_PORTS, a map of UIDs to serial port names, to DEVICE_CACHE_FILE.
+    """
+    if not DEVICE_CACHE_FILE:
+        return
+    port_ids = get_port_ids()
+    entries = [{"port": port, "id": port_ids.get(os.path.realpath(port)), "uid": uid}
+               for uid, port in device_ports.items()]
+    temp_file = DEVICE_CACHE_FILE + ".tmp"
+    try:
+        with open(temp_file, "w") as cache_file:
+            json.dump(entries, cache_file)
+        os.replace(temp_file, DEVICE_CACHE_FILE)
+    except IOError:
+        pass
+
+
 def identify_smart_sensors(serial_conns):
     """
     Given a list of serial port connections, figure out which
     contain smart sensors.
 
+    Every port is pinged at once, and pinged again every
+    IDENTIFY_RETRY_INTERVAL seconds until it answers, all within a
+    single IDENTIFY_TIMEOUT, however many ports there are.
+
     Returns:
         A map of serial port names to UIDs.
     """
@@ -75,61 +202,96 @@ def identify_smart_sensors(serial_conns):
                 msg_type = packet.get_message_id()
                 if msg_type == hm.MESSAGE_TYPES["SubscriptionResponse"]:
                     _, _, uid = hm.parse_subscription_response(packet)
-                    uid_queue.put(uid)
+                    uid_queue.put((conn, uid))
         except serial.SerialException:
             pass
 
-
-    device_map = {}
+    start = time.time()
+    deadline = start + IDENTIFY_TIMEOUT
+    uid_queue = queue.Queue()
+    stop_event = threading.Event()
+    old_timeouts = {}
     candidates = []
     for conn in serial_conns:
-        old_timeout = conn.write_timeout
-        conn.write_timeout = IDENTIFY_TIMEOUT
-        try:
-            hm.send(conn, hm.make_ping())
-        except serial.SerialTimeoutException:
+        if not ping_port(conn, deadline - time.time()):
             continue
-        finally:
-            conn.write_timeout = old_timeout
-        maybe_device = namedtuple("MaybeDevice", ["serial_conn", "queue", "event", "thread"])
-        maybe_device.queue = queue.Queue()
-        maybe_device.event = threading.Event()
-        maybe_device.serial_conn = conn
-        maybe_device.thread = threading.Thread(target=recv_subscription_response,
-                                               args=(conn, maybe_device.queue, maybe_device.event))
-        candidates.append(maybe_device)
-    for cand in candidates:
-        cand.thread.start()
-    for cand in candidates:
+        # Make reads give up regularly, so the thread notices when to stop
+        old_timeouts[conn] = conn.timeout
+        conn.timeout = IDENTIFY_RETRY_INTERVAL
+        thread = threading.Thread(target=recv_subscription_response,
+                                  args=(conn, uid_queue, stop_event))
+        thread.start()
+        candidates.append((conn, thread))
+
+    device_map = {}
+    next_ping = start + IDENTIFY_RETRY_INTERVAL
+    while len(device_map) < len(candidates):
+        now = time.time()
+        if now >= deadline:
+            break
         try:
-            uid = cand.queue.get(block=True, timeout=IDENTIFY_TIMEOUT)
-            device_map[cand.serial_conn.name] = uid
-            # Shut device up
-            hm.send(cand.serial_conn, hm.make_subscription_request(uid, [], 0))
+            conn, uid = uid_queue.get(timeout=min(deadline, next_ping) - now)
         except queue.Empty:
-            pass
-    for cand in candidates:
-        cand.event.set()
-        cand.thread.join()
+            if time.time() >= next_ping:
+                for conn, _ in candidates:
+                    if conn.name not in device_map:
+                        ping_port(conn, deadline - time.time())
+                next_ping += IDENTIFY_RETRY_INTERVAL
+            continue
+        if conn.name in device_map:
+            continue
+        device_map[conn.name] = uid
+        print("Identified device %d on %s in %.1f ms"
+              % (uid, conn.name, 1000 * (time.time() - start)))
+        # Shut device up
+        hm.send(conn, hm.make_subscription_request(uid, [], 0))
+
+    stop_event.set()
+    for conn, thread in candidates:
+        thread.join()
+        conn.timeout = old_timeouts[conn]
     return device_map
 
 
-def spin_up_device(serial_port, uid, state_queue, batched_data, error_queue):
+def ping_port(conn, timeout):
+    """
+    Ping CONN, giving up on writing the ping after TIMEOUT seconds.
+
+    Returns:
+        Whether the ping was sent.
+    """
+    old_timeout = conn.write_timeout
+    conn.write_timeout = max(timeout, 0)
+    try:
+        hm.send(conn, hm.make_ping())
+        return True
+    except serial.SerialException:
+        return False
+    finally:
+        conn.write_timeout = old_timeout
+
+
+def spin_up_device(serial_port, uid, state_queue, publisher, error_queue):
     """
     Spin up a device with a given UID on SERIAL_PORT.
 
     Returns:
         The new device.
     """
-    pack = namedtuple("Threadpack", ["read_thread", "write_thread",
-                                     "write_queue", "serial_port", "instance_id"])
+    pack = namedtuple("Threadpack", ["read_thread", "write_thread", "write_queue",
+                                     "serial_port", "instance_id", "verified", "stop"])
     pack.write_queue = queue.Queue()
     pack.serial_port = serial_port
+    # Set once the device answers with UID, and the state manager
+    # has been told about it
+    pack.verified = threading.Event()
+    # Set when the device is removed, to stop its threads
+    pack.stop = threading.Event()
     pack.write_thread = threading.Thread(target=device_write_thread,
-                                         args=(serial_port, pack.write_queue))
+                                         args=(serial_port, pack.write_queue, pack.stop))
     pack.read_thread = threading.Thread(target=device_read_thread,
                                         args=(uid, pack, error_queue,
-                                              state_queue, batched_data))
+                                              state_queue, publisher))
     # This is an ID that does not persist across disconnects,
     # so that we can tell when a device has been reconnected.
     pack.instance_id = random.getrandbits(128)
@@ -138,20 +300,66 @@ def spin_up_device(serial_port, uid, state_queue, batched_data, error_queue):
     return pack
 
 
-def hotplug(devices, state_queue, batched_data, error_queue):
+def spin_up_cached_devices(devices, state_queue, publisher, error_queue):
     """
-    Remove disconnected devices and scan for new ones.
+    Spin up the devices that were on each port last time (see
+    `load_device_cache`), and add them to DEVICES.
+
+    They're pinged straight away. Any that don't answer as the device
+    we expected within IDENTIFY_TIMEOUT are treated as disconnected,
+    so their ports get identified properly on the next scan.
     """
-    clean_up_queue = queue.Queue()
-    clean_up_thread = threading.Thread(target=clean_up_devices, args=(clean_up_queue, ))
-    clean_up_thread.start()
-    while True:
-        time.sleep(HOTPLUG_POLL_INTERVAL)
-        scan_for_new_devices(devices, state_queue, batched_data, error_queue)
-        remove_disconnected_devices(error_queue, devices, clean_up_queue, state_queue)
+    cached = load_device_cache()
+    serials, _ = open_serial_ports(cached)
+    packs = []
+    for serial_port in serials:
+        uid = cached[serial_port.name]
+        if uid in devices:
+            serial_port.close()
+            continue
+        pack = spin_up_device(serial_port, uid, state_queue, publisher, error_queue)
+        devices[uid] = pack
+        packs.append((uid, pack))
+        pack.write_queue.put(("ping", []))
+        pack.write_queue.put(("subscribe", [1, 0, []]))
+    if packs:
+        timer = threading.Timer(IDENTIFY_TIMEOUT, report_unverified_devices,
+                                args=(packs, error_queue))
+        timer.daemon = True
+        timer.start()
+
+
+def report_unverified_devices(packs, error_queue):
+    """
+    Report the devices in PACKS, a list of (UID, device) tuples, that
+    haven't answered as disconnected.
+    """
+    for uid, pack in packs:
+        if not pack.verified.is_set():
+            report_disconnect(uid, pack, error_queue)
 
 
-def scan_for_new_devices(existing_devices, state_queue, batched_data, error_queue):
+def hotplug(devices, state_queue, publisher, error_queue, port_watcher):
+    """
+    Remove disconnected devices and scan for new ones, as soon as
+    PORT_WATCHER sees ports go away or appear.
+    """
+    port_closer = PortCloser()
+    next_clean_up = time.time() + HOTPLUG_POLL_INTERVAL
+    next_rescan = time.time() + HOTPLUG_RESCAN_INTERVAL
+    while True:
+        added, removed = port_watcher.wait(max(next_clean_up - time.time(), 0))
+        if removed:
+            remove_devices_on_ports(removed, devices, port_closer, publisher)
+        if added or time.time() >= next_rescan:
+            scan_for_new_devices(devices, state_queue, publisher, error_queue)
+            next_rescan = time.time() + HOTPLUG_RESCAN_INTERVAL
+        if time.time() >= next_clean_up:
+            remove_disconnected_devices(error_queue, devices, port_closer, publisher)
+            next_clean_up = time.time() + HOTPLUG_POLL_INTERVAL
+
+
+def scan_for_new_devices(existing_devices, state_queue, publisher, error_queue):
     """
     Find devices that are on serial ports not in EXISTING_DEVICES, and add
     any that have been found to it.
@@ -162,29 +370,17 @@ def scan_for_new_devices(existing_devices, state_queue, batched_data, error_queu
     for (ser, uid) in sensors.items():
         idx = names.index(ser)
         port = ports[idx]
-        pack = spin_up_device(port, uid, state_queue, batched_data, error_queue)
+        pack = spin_up_device(port, uid, state_queue, publisher, error_queue)
         existing_devices[uid] = pack
         # Tell the device to start sending data
         pack.write_queue.put(("ping", []))
         pack.write_queue.put(("subscribe", [1, 0, []]))
+    if sensors:
+        save_device_cache({dev_uid: dev.serial_port.name
+                           for dev_uid, dev in existing_devices.items()})
 
 
-def clean_up_devices(device_queue):
-    """
-    Clean up associated resources of devices in the queue.
-
-    Closing a serial port can take a very long time (30 seconds or more).
-    It's best to spin this function off into its own thread,
-    so that you're not blocked on reclaiming resources.
-    """
-    while True:
-        device = device_queue.get()
-        device.serial_port.close()
-        device.read_thread.join()
-        device.write_thread.join()
-
-
-def remove_disconnected_devices(error_queue, devices, clean_up_queue, state_queue):
+def remove_disconnected_devices(error_queue, devices, port_closer, publisher):
     """
     Clean up any disconnected devices in ERROR_QUEUE.
     """
@@ -192,8 +388,11 @@ def remove_disconnected_devices(error_queue, devices, clean_up_queue, state_queu
     while True:
         try:
             error = error_queue.get(block=False)
-            pack = devices[error.uid]
-            if not error.accessed:
+            pack = devices.get(error.uid)
+            if pack is None:
+                # Already cleaned up (e.g. reported again as its port closed)
+                continue
+            elif not error.accessed and pack.verified.is_set():
                 # Wait until the next cycle to make sure it's disconnected
                 error.accessed = True
                 next_time_errors.append(error)
@@ -201,47 +400,76 @@ def remove_disconnected_devices(error_queue, devices, clean_up_queue, state_queu
             elif error.instance_id != pack.instance_id:
                 # The device has reconnected in the meantime
                 continue
-            uid = error.uid
-            pack = devices[uid]
-            del devices[uid]
-            clean_up_queue.put(pack)
-            state_queue.put(("device_disconnected", [uid]))
+            remove_device(error.uid, devices, port_closer, publisher)
         except queue.Empty:
             for err in next_time_errors:
                 error_queue.put(err)
             return
 
 
+def remove_devices_on_ports(ports, devices, port_closer, publisher):
+    """
+    Clean up the devices on PORTS straight away, since the ports are gone.
+    """
+    for uid, pack in list(devices.items()):
+        if pack.serial_port.name in ports:
+            remove_device(uid, devices, port_closer, publisher)
+
+
+def remove_device(uid, devices, port_closer, publisher):
+    """
+    Remove the device with UID from DEVICES, close its port with
+    PORT_CLOSER, and tell the state manager it's gone if it knew about it.
+    """
+    pack = devices.pop(uid)
+    pack.stop.set()
+    # Wake the write thread up, so it sees it's been stopped
+    pack.write_queue.put(("stop", []))
+    port_closer.close(pack.serial_port, [pack.read_thread, pack.write_thread])
+    if pack.verified.is_set():
+        publisher.reset(uid, "device_disconnected", [uid])
+    save_device_cache({dev_uid: dev.serial_port.name for dev_uid, dev in devices.items()})
+
+
+def hibike_process(bad_things_queue, state_queue, pipe_from_child, engine=None,
+                   sensor_table=None, latency_trace=None):
+    """
+    Run the main hibike process, using ENGINE (by default, DEFAULT_ENGINE).
+
+    If SENSOR_TABLE (a `sensor_table.SensorTable`) is given, device values
+    are also written into it as soon as they arrive. If LATENCY_TRACE (a
+    `latency_trace.LatencyTrace`) is given, how long values wait to be
+    published is recorded in it, and published values are timestamped.
+    """
+    ENGINES[engine or DEFAULT_ENGINE](bad_things_queue, state_queue, pipe_from_child,
+                                      sensor_table, latency_trace)
+
+
 # pylint: disable=too-many-branches, too-many-locals
 # pylint: disable=too-many-arguments, unused-argument
-def hibike_process(bad_things_queue, state_queue, pipe_from_child):
+def threaded_hibike_process(bad_things_queue, state_queue, pipe_from_child, sensor_table=None,
+                            latency_trace=None):
     """
-    Run the main hibike processs.
+    Run the main hibike process, with a read and a write thread per device.
     """
-    serials, serial_names = get_working_serial_ports()
-    smart_sensors = identify_smart_sensors(serials)
     devices = {}
-
-    batched_data = {}
+    publisher = DeviceValuePublisher(state_queue, sensor_table=sensor_table,
+                                     latency_trace=latency_trace)
     error_queue = queue.Queue()
 
-    for (ser, uid) in smart_sensors.items():
-        index = serial_names.index(ser)
-        serial_port = serials[index]
-        pack = spin_up_device(serial_port, uid, state_queue, batched_data, error_queue)
-        devices[uid] = pack
-
-    batch_thread = threading.Thread(target=batch_data, args=(batched_data, state_queue))
-    batch_thread.start()
+    publish_thread = threading.Thread(target=publisher.run)
+    publish_thread.start()
+    # Start watching before the first scan, so no new ports are missed
+    port_watcher = make_port_watcher()
+    # Bring up the devices we already know about, then identify the rest.
+    # Either way, devices are pinged and told to stop sending data.
+    spin_up_cached_devices(devices, state_queue, publisher, error_queue)
+    scan_for_new_devices(devices, state_queue, publisher, error_queue)
     hotplug_thread = threading.Thread(target=hotplug,
-                                      args=(devices, state_queue, batched_data, error_queue))
+                                      args=(devices, state_queue, publisher, error_queue,
+                                            port_watcher))
     hotplug_thread.start()
 
-    # Pings all devices and tells them to stop sending data
-    for pack in devices.values():
-        pack.write_queue.put(("ping", []))
-        pack.write_queue.put(("subscribe", [1, 0, []]))
-
     # the main thread reads instructions from statemanager and
     # forwards them to the appropriate device write threads
     while True:
@@ -258,78 +486,279 @@ def hibike_process(bad_things_queue, state_queue, pipe_from_child):
                 uid = args[0]
                 if uid in devices:
                     devices[uid].write_queue.put(("write", args))
+            elif instruction == "write_devices":
+                for uid, params_and_values in args[0].items():
+                    if uid in devices:
+                        devices[uid].write_queue.put(("write", [uid, params_and_values]))
             elif instruction == "read_params":
                 uid = args[0]
                 if uid in devices:
                     devices[uid].write_queue.put(("read", args))
             elif instruction == "disable_all":
                 for pack in devices.values():
+                    # Anything the device hasn't read yet is out of date
+                    discard_output(pack.serial_port)
                     pack.write_queue.put(("disable", []))
+            elif instruction == "timestamp_down":
+                state_queue.put(("timestamp_up", args + [time.monotonic()]))
         except KeyError:
             print("Tried to access a nonexistent device")
 
 
-def device_write_thread(ser, instr_queue):
+def get_instructions(instr_queue, lanes):
     """
-    Send packets to SER based on instructions from INSTR_QUEUE.
+    Wait for an instruction on INSTR_QUEUE, unless there are some in
+    LANES (an `InstructionLanes`) already, then move every instruction
+    waiting on INSTR_QUEUE into LANES.
     """
+    if not lanes:
+        lanes.append(instr_queue.get())
+    while True:
+        try:
+            lanes.append(instr_queue.get_nowait())
+        except queue.Empty:
+            break
+
+
+def device_write_thread(ser, instr_queue, stop_event):
+    """
+    Send packets to SER based on instructions from INSTR_QUEUE,
+    until STOP_EVENT is set.
+
+    Only the most urgent instruction (see `InstructionLanes`) is sent
+    before checking for new ones, so a disable never waits for more
+    than one other packet.
+    """
+    # Every packet is built in this buffer before it's written out
+    frame = bytearray(hm.MAX_FRAME_SIZE)
+    lanes = InstructionLanes()
     try:
-        while True:
-            instruction, args = instr_queue.get()
-
-            if instruction == "ping":
-                hm.send(ser, hm.make_ping())
-            elif instruction == "subscribe":
-                uid, delay, params = args
-                hm.send(ser, hm.make_subscription_request(hm.uid_to_device_id(uid), params, delay))
-            elif instruction == "read":
-                uid, params = args
-                hm.send(ser, hm.make_device_read(hm.uid_to_device_id(uid), params))
-            elif instruction == "write":
-                uid, params_and_values = args
-                hm.send(ser, hm.make_device_write(hm.uid_to_device_id(uid), params_and_values))
-            elif instruction == "disable":
-                hm.send(ser, hm.make_disable())
-            elif instruction == "heartResp":
-                uid = args[0]
-                hm.send(ser, hm.make_heartbeat_response())
+        while not stop_event.is_set():
+            get_instructions(instr_queue, lanes)
+            instruction, args = lanes.pop()
+            if stop_event.is_set():
+                return
+            send_instruction(ser, instruction, args, frame)
     except serial.SerialException:
         # Device has disconnected
         pass
 
 
-def device_read_thread(uid, pack, error_queue, state_queue, batched_data):
+def send_instruction(ser, instruction, args, frame):
+    """
+    Send the packet for INSTRUCTION with ARGS to SER, building it in FRAME.
     """
-    Read packets from SER and update queues and BATCHED_DATA accordingly.
+    if instruction == "ping":
+        hm.send(ser, hm.make_ping(), frame)
+    elif instruction == "subscribe":
+        uid, delay, params = args
+        hm.send(ser, hm.make_subscription_request(hm.uid_to_device_id(uid), params, delay),
+                frame)
+    elif instruction == "read":
+        uid, params = args
+        hm.send(ser, hm.make_device_read(hm.uid_to_device_id(uid), params), frame)
+    elif instruction == "write":
+        uid, params_and_values = args
+        hm.send(ser, hm.make_device_write(hm.uid_to_device_id(uid), params_and_values.items()),
+                frame)
+    elif instruction == "disable":
+        # An extra delimiter first, in case the device was sent part of a
+        # packet before the rest was discarded (see `discard_output`)
+        ser.write(b"\x00")
+        hm.send(ser, hm.make_disable(), frame)
+    elif instruction == "heartResp":
+        uid = args[0]
+        hm.send(ser, hm.make_heartbeat_response(), frame)
+
+
+def device_read_thread(uid, pack, error_queue, state_queue, publisher):
+    """
+    Read packets from SER and update queues and PUBLISHER accordingly,
+    until the device is stopped.
     """
     ser = pack.serial_port
     instruction_queue = pack.write_queue
     try:
-        while True:
-            for packet in hm.blocking_read_generator(ser):
+        while not pack.stop.is_set():
+            for packet in hm.blocking_read_generator(ser, pack.stop):
                 message_type = packet.get_message_id()
-                if message_type == hm.MESSAGE_TYPES["SubscriptionResponse"]:
-                    params, delay, uid = hm.parse_subscription_response(packet)
-                    state_queue.put(("device_subscribed", [uid, delay, params]))
-                elif message_type == hm.MESSAGE_TYPES["DeviceData"]:
-                    params_and_values = hm.parse_device_data(packet, hm.uid_to_device_id(uid))
-                    batched_data[uid] = params_and_values
-                elif message_type == hm.MESSAGE_TYPES["HeartBeatRequest"]:
-                    instruction_queue.put(("heartResp", [uid]))
+                try:
+                    if message_type == hm.MESSAGE_TYPES["SubscriptionResponse"]:
+                        params, delay, response_uid = hm.parse_subscription_response(packet)
+                        if response_uid != uid:
+                            # Not the device we thought was here (see load_device_cache)
+                            report_disconnect(uid, pack, error_queue)
+                            return
+                        pack.verified.set()
+                        publisher.reset(uid, "device_subscribed", [uid, delay, params])
+                    elif (message_type == hm.MESSAGE_TYPES["DeviceData"]
+                          and pack.verified.is_set()):
+                        params_and_values = hm.parse_device_data(packet,
+                                                                 hm.uid_to_device_id(uid))
+                        publisher.update(uid, params_and_values)
+                    elif message_type == hm.MESSAGE_TYPES["HeartBeatRequest"]:
+                        instruction_queue.put(("heartResp", [uid]))
+                except hm.PAYLOAD_ERRORS:
+                    # A garbled packet; the next one may well be fine
+                    continue
     except serial.SerialException:
-        error = namedtuple("Disconnect", ["uid", "instance_id", "accessed"])
-        error.uid = uid
-        error.instance_id = pack.instance_id
-        error.accessed = False
-        error_queue.put(error)
+        report_disconnect(uid, pack, error_queue)
 
-def batch_data(data, state_queue):
+
+def report_disconnect(uid, pack, error_queue):
     """
-    Write out DATA to STATE_QUEUE periodically.
+    Tell the hotplug thread, through ERROR_QUEUE, that the device
+    with UID and PACK has gone away.
     """
-    while True:
-        time.sleep(BATCH_SLEEP_TIME)
-        state_queue.put(("device_values", [data]))
+    error = namedtuple("Disconnect", ["uid", "instance_id", "accessed"])
+    error.uid = uid
+    error.instance_id = pack.instance_id
+    error.accessed = False
+    error_queue.put(error)
+
+
+class DeviceValuePublisher:
+    """
+    Send device values to the state manager as they change.
+
+    Only parameters whose values differ from what was last sent are
+    published, as one ("device_values", [{uid: [(param, value), ...]}])
+    message per flush. Changes are flushed as soon as they arrive, but
+    no more often than every MIN_INTERVAL seconds; changes arriving in
+    between are held back and sent together.
+
+    Values are recorded from any thread; flushing is done either by
+    `run` on a thread of its own, or by calling `publish` once
+    `deadline` has passed. If there is a SENSOR_TABLE, values are
+    written into it straight away, as well.
+
+    If there is a LATENCY_TRACE, the time each message is sent, and the
+    time the oldest value of each device in it arrived (both from
+    `time.monotonic`), are added to it: ("device_values", [data,
+    published, {uid: received}]). How long values were held back is
+    recorded in the trace, too.
+    """
+    def __init__(self, state_queue, min_interval=None, sensor_table=None, latency_trace=None):
+        self.state_queue = state_queue
+        self.sensor_table = sensor_table
+        self.latency_trace = latency_trace
+        if min_interval is None:
+            min_interval = PUBLISH_MIN_INTERVAL
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        # UID: {param: value}, for values not sent yet
+        self.pending = {}
+        # UID: {param: value}, for values the state manager has
+        self.published = {}
+        # UID: time its oldest pending value arrived, if tracing latency
+        self.received = {}
+        self.next_publish = 0
+
+    def update(self, uid, params_and_values):
+        """
+        Record PARAMS_AND_VALUES received from the device at UID.
+        """
+        with self.lock:
+            if self.sensor_table is not None:
+                self.sensor_table.update(uid, params_and_values)
+            published = self.published.get(uid, {})
+            pending = None
+            for param, value in params_and_values:
+                if param in published and published[param] == value:
+                    # Back to what the state manager has, so any other
+                    # value waiting to be sent is out of date
+                    stale = self.pending.get(uid)
+                    if stale:
+                        stale.pop(param, None)
+                        if not stale:
+                            del self.pending[uid]
+                            self.received.pop(uid, None)
+                    continue
+                if pending is None:
+                    pending = self.pending.setdefault(uid, {})
+                pending[param] = value
+            if pending is not None:
+                if self.latency_trace is not None:
+                    self.received.setdefault(uid, time.monotonic())
+                self.changed.notify()
+
+    def reset(self, uid, command, args):
+        """
+        Send (COMMAND, ARGS), which clears UID's values in the state
+        manager, and forget which values it has for UID.
+        """
+        with self.lock:
+            self.published.pop(uid, None)
+            if command == "device_disconnected":
+                self.pending.pop(uid, None)
+                self.received.pop(uid, None)
+                if self.sensor_table is not None:
+                    self.sensor_table.remove(uid)
+            elif self.sensor_table is not None and not self.sensor_table.add(uid):
+                print("No room in the sensor table for device: " + str(uid))
+            self.state_queue.put((command, args))
+
+    def deadline(self):
+        """
+        The time at which pending values are due to be published,
+        or None if there aren't any.
+        """
+        with self.lock:
+            return self.next_publish if self.pending else None
+
+    def publish(self):
+        """
+        Send pending values to the state manager.
+        """
+        with self.lock:
+            if not self.pending:
+                return
+            data = {}
+            for uid, params in self.pending.items():
+                data[uid] = list(params.items())
+                self.published.setdefault(uid, {}).update(params)
+            self.pending = {}
+            message = [data]
+            if self.latency_trace is not None:
+                now = time.monotonic()
+                for received in self.received.values():
+                    self.latency_trace.record("receive_to_publish", now - received)
+                message += [now, self.received]
+                self.received = {}
+            self.state_queue.put(("device_values", message))
+            self.next_publish = time.time() + self.min_interval
+
+    def run(self):
+        """
+        Publish changes as they arrive, forever.
+        """
+        while True:
+            with self.changed:
+                while not self.pending:
+                    self.changed.wait()
+                delay = self.next_publish - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self.publish()
+
+
+def selector_hibike_process(bad_things_queue, state_queue, pipe_from_child, sensor_table=None,
+                            latency_trace=None):
+    """
+    Run the main hibike process, with all devices on one event loop
+    (see `selector_engine`).
+    """
+    # The selector engine uses this module's port and cache handling
+    # pylint: disable=import-outside-toplevel,cyclic-import
+    from selector_engine import SelectorEngine
+    SelectorEngine(state_queue, pipe_from_child, sensor_table, latency_trace).run()
+
+
+ENGINES = {
+    "threads": threaded_hibike_process,
+    "selector": selector_hibike_process,
+}
 
 
 #############
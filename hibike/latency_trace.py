@@ -0,0 +1,142 @@
+"""
+Histograms of how long sensor values take to get from a device's serial
+port to each stage of runtime.
+
+Every stage is timed with `time.monotonic`, which all processes on the
+same machine share. The histograms live in shared memory, so the hibike
+process, the state manager and student code can each record their own
+part of the trip, and any of them can report the whole thing.
+"""
+import bisect
+import multiprocessing
+
+__all__ = ["LatencyTrace"]
+
+
+# The hops of a sensor value's trip that are timed:
+#   receive_to_publish: hibike receiving it, to hibike sending it to the state manager
+#   publish_to_apply: hibike sending it, to the state manager storing it
+#   receive_to_apply: hibike receiving it, to the state manager storing it
+#   receive_to_read: hibike receiving it, to student code reading it
+HOPS = ["receive_to_publish", "publish_to_apply", "receive_to_apply", "receive_to_read"]
+# Upper bounds of the histogram buckets, in seconds; a last bucket holds the rest
+BUCKET_BOUNDS = [.0001, .0002, .0005, .001, .002, .005, .01, .02, .05, .1, .2, .5, 1]
+# Every hop has a row of: number of values, total seconds, most seconds,
+# then the number of values in each bucket
+COUNT, TOTAL, MAXIMUM, BUCKETS = range(4)
+ROW_SIZE = BUCKETS + len(BUCKET_BOUNDS) + 1
+# Percentiles given by `LatencyTrace.summary`
+PERCENTILES = [50, 90, 99]
+
+
+def format_seconds(seconds):
+    """
+    Format SECONDS in milliseconds, for reports.
+    """
+    if seconds == float("inf"):
+        return "inf"
+    return "%.1f ms" % (seconds * 1000)
+
+
+class LatencyTrace:
+    """
+    A latency histogram for every hop in HOPS, in a shared buffer.
+
+    Create it before starting the processes that use it, and pass it to
+    them as an argument. Each hop should only be recorded by one process,
+    and one thread at a time; any number of processes can read them.
+    Nothing is locked, so a reader may see a hop a value or two behind.
+    """
+    def __init__(self, buffer=None):
+        if buffer is None:
+            buffer = multiprocessing.RawArray("d", len(HOPS) * ROW_SIZE)
+        self._buffer = buffer
+        # Hop: offset of its row
+        self._rows = {hop: index * ROW_SIZE for index, hop in enumerate(HOPS)}
+
+    def __getstate__(self):
+        return self._buffer
+
+    def __setstate__(self, buffer):
+        self.__init__(buffer=buffer)
+
+    def record(self, hop, seconds):
+        """
+        Record that a value took SECONDS to make HOP.
+        """
+        seconds = max(seconds, 0)
+        base = self._rows[hop]
+        buf = self._buffer
+        buf[base + COUNT] += 1
+        buf[base + TOTAL] += seconds
+        if seconds > buf[base + MAXIMUM]:
+            buf[base + MAXIMUM] = seconds
+        buf[base + BUCKETS + bisect.bisect_left(BUCKET_BOUNDS, seconds)] += 1
+
+    def histogram(self, hop):
+        """
+        Read the histogram of HOP.
+
+        Returns:
+            A list of (upper bound in seconds, number of values) for every
+            bucket; the last bound is infinity.
+        """
+        base = self._rows[hop] + BUCKETS
+        counts = self._buffer[base:base + len(BUCKET_BOUNDS) + 1]
+        return list(zip(BUCKET_BOUNDS + [float("inf")], (int(count) for count in counts)))
+
+    def summary(self, hop):
+        """
+        Summarize the histogram of HOP.
+
+        Returns:
+            A dict of "count", "mean" and "max" (in seconds), and the upper
+            bound of the bucket holding each of the PERCENTILES (e.g. "p90"),
+            or None if nothing has been recorded for HOP.
+        """
+        base = self._rows[hop]
+        count = int(self._buffer[base + COUNT])
+        if not count:
+            return None
+        summary = {
+            "count": count,
+            "mean": self._buffer[base + TOTAL] / count,
+            "max": self._buffer[base + MAXIMUM],
+        }
+        histogram = self.histogram(hop)
+        for percentile in PERCENTILES:
+            wanted = count * percentile / 100
+            seen = 0
+            for bound, bucket_count in histogram:
+                seen += bucket_count
+                if seen >= wanted:
+                    break
+            summary["p%d" % percentile] = bound
+        return summary
+
+    def report(self):
+        """
+        Describe every hop that something has been recorded for.
+
+        Returns:
+            A string with one line per hop.
+        """
+        lines = []
+        for hop in HOPS:
+            summary = self.summary(hop)
+            if summary is None:
+                continue
+            percentiles = " ".join("p%d<=%s" % (percentile,
+                                                format_seconds(summary["p%d" % percentile]))
+                                   for percentile in PERCENTILES)
+            lines.append("%-18s n=%-7d mean=%s %s max=%s" % (
+                hop, summary["count"], format_seconds(summary["mean"]), percentiles,
+                format_seconds(summary["max"])))
+        return "\n".join(lines)
+
+    def reset(self):
+        """
+        Forget everything that has been recorded.
+        """
+        for index in range(len(self._buffer)):
+            self._buffer[index] = 0
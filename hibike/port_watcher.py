@@ -0,0 +1,199 @@
+"""
+Notice serial ports appearing and disappearing.
+
+On Linux, the directories holding the ports are watched with inotify, so
+changes are noticed as soon as they happen. Elsewhere, or if inotify
+can't be used, the ports are listed again every so often instead.
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+__all__ = ["PortWatcher"]
+
+
+# inotify event types (see inotify(7))
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_IGNORED = 0x8000
+# Files being created, removed or renamed, having their permissions changed
+# (udev does this just after a port appears), or being rewritten (e.g. the
+# list of virtual ports)
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+# Every event starts with: watch descriptor, mask, cookie, length of name
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def load_inotify():
+    """
+    Find the inotify functions in the C library.
+
+    Returns:
+        The C library, or None if it doesn't have inotify.
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+LIBC = load_inotify()
+
+
+class PortWatcher:
+    """
+    Keep track of which of the serial ports listed by LIST_PORTS exist,
+    and report the ones that have come or gone.
+
+    LIST_PORTS is called with no arguments and returns port names. The
+    DIRECTORIES (and the directories of the listed ports) are watched for
+    changes, so they should include every directory a new port could
+    appear in, as well as any holding files that LIST_PORTS reads.
+
+    Without inotify (or if INOTIFY is False), the ports are listed
+    every POLL_INTERVAL seconds instead.
+    """
+    def __init__(self, list_ports, directories=(), poll_interval=1, inotify=True):
+        self.list_ports = list_ports
+        self.directories = set(directories)
+        self.poll_interval = poll_interval
+        self.next_poll = time.time() + poll_interval
+        self._fd = None
+        # Watch descriptor: directory
+        self._watches = {}
+        if inotify and LIBC is not None:
+            fd = LIBC.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd >= 0:
+                self._fd = fd
+        self.ports = self._refresh()
+
+    def fileno(self):
+        """
+        The inotify file descriptor, which is readable whenever there
+        may be changes, or None if the ports are being polled.
+        """
+        return self._fd
+
+    def deadline(self):
+        """
+        The time when the ports should next be polled, or None if
+        they're being watched.
+        """
+        if self._fd is not None:
+            return None
+        return self.next_poll
+
+    def changes(self):
+        """
+        Find out, without blocking, which ports have appeared and which
+        have gone away since last time.
+
+        A port is also reported as new if it has changed (e.g. had its
+        permissions fixed), in case it couldn't be opened before.
+
+        Returns:
+            A tuple of (set of new ports, set of ports that are gone).
+        """
+        if self._fd is None:
+            if time.time() < self.next_poll:
+                return set(), set()
+            self.next_poll = time.time() + self.poll_interval
+            touched = set()
+        else:
+            touched = self._read_events()
+            if touched is None:
+                return set(), set()
+        ports = self._refresh()
+        added = (ports - self.ports) | (ports & touched)
+        removed = self.ports - ports
+        self.ports = ports
+        return added, removed
+
+    def wait(self, timeout):
+        """
+        Wait up to TIMEOUT seconds for ports to appear or go away.
+
+        Returns:
+            The same as `changes`; both sets are empty if nothing changed.
+        """
+        end = time.time() + timeout
+        while True:
+            remaining = end - time.time()
+            if self._fd is None:
+                time.sleep(max(min(remaining, self.next_poll - time.time()), 0))
+            else:
+                select.select([self._fd], [], [], max(remaining, 0))
+            added, removed = self.changes()
+            if added or removed or time.time() >= end:
+                return added, removed
+
+    def close(self):
+        """
+        Stop watching for changes.
+        """
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _refresh(self):
+        """
+        List the ports, and start watching any directories they're in
+        that aren't being watched yet.
+
+        Returns:
+            The set of listed ports that exist right now.
+        """
+        listed = set(self.list_ports())
+        if self._fd is not None:
+            directories = self.directories | {os.path.dirname(port) for port in listed}
+            for directory in directories - set(self._watches.values()):
+                wd = LIBC.inotify_add_watch(self._fd, os.fsencode(directory), WATCH_MASK)
+                if wd >= 0:
+                    self._watches[wd] = directory
+        return {port for port in listed if os.path.exists(port)}
+
+    def _read_events(self):
+        """
+        Read every pending inotify event.
+
+        Returns:
+            The set of paths the events were about, or None if there
+            weren't any.
+        """
+        data = b""
+        while True:
+            try:
+                chunk = os.read(self._fd, 4096)
+            except BlockingIOError:
+                break
+            if not chunk:
+                break
+            data += chunk
+        if not data:
+            return None
+        paths = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_IGNORED:
+                # The directory itself went away
+                self._watches.pop(wd, None)
+            elif wd in self._watches and name:
+                paths.add(os.path.join(self._watches[wd], os.fsdecode(name)))
+        return paths
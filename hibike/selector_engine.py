@@ -0,0 +1,339 @@
+"""
+The selector engine of the hibike process: every serial port is run
+non-blocking from one event loop, instead of by a pair of threads each.
+"""
+import os
+import selectors
+import time
+
+# pylint: disable=import-error
+import hibike_message as hm
+from device_helpers import InstructionLanes, PortCloser, discard_output
+from hibike_process import (DeviceValuePublisher, HOTPLUG_RESCAN_INTERVAL, IDENTIFY_RETRY_INTERVAL,
+                            IDENTIFY_TIMEOUT, get_working_serial_ports, load_device_cache,
+                            make_port_watcher, open_serial_ports, save_device_cache,
+                            send_instruction)
+
+__all__ = ["SelectorEngine"]
+
+
+# Bytes of packets the selector engine frames for a port ahead of what
+# the port has taken; everything else waits its turn by priority
+MAX_OUT_BUFFER = 256
+
+
+class SerialConnection:
+    """
+    A serial port run by the selector engine.
+
+    Packets bound for the port are framed into an output buffer, which
+    is written out whenever the port is ready for it.
+    """
+    def __init__(self, serial_port, identify_deadline):
+        self.serial_port = serial_port
+        self.fd = serial_port.fileno()
+        os.set_blocking(self.fd, False)
+        self.decoder = hm.FrameDecoder()
+        self.out_buffer = bytearray()
+        self.instructions = InstructionLanes()
+        # None until the device answers a ping
+        self.uid = None
+        # Whether the device has answered as UID, and the state
+        # manager has been told about it
+        self.verified = False
+        self.identify_start = time.time()
+        self.identify_deadline = identify_deadline
+        # When to ping again, if the device hasn't answered by then
+        self.next_ping = self.identify_start + IDENTIFY_RETRY_INTERVAL
+
+    def write(self, data):
+        """
+        Queue DATA to be written to the port.
+        """
+        self.out_buffer += data
+
+
+class SelectorEngine:
+    """
+    Run every serial port non-blocking from a single event loop.
+
+    Reads, writes, instructions from the state manager, device
+    identification, hotplugging and publishing values all happen on one
+    thread, driven by a `selectors` selector; closing ports (which can
+    block for a long time) is left to a `PortCloser`.
+    """
+    # Maps instructions from the state manager to device instructions
+    DEVICE_INSTRUCTIONS = {
+        "subscribe_device": "subscribe",
+        "write_params": "write",
+        "read_params": "read",
+    }
+
+    def __init__(self, state_queue, pipe_from_child, sensor_table=None, latency_trace=None):
+        self.state_queue = state_queue
+        self.pipe = pipe_from_child
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(pipe_from_child, selectors.EVENT_READ)
+        # Port name: SerialConnection, for every open port
+        self.connections = {}
+        # UID: SerialConnection, for identified devices
+        self.devices = {}
+        self.publisher = DeviceValuePublisher(state_queue, sensor_table=sensor_table,
+                                              latency_trace=latency_trace)
+        self.frame = bytearray(hm.MAX_FRAME_SIZE)
+        self.port_closer = None
+        self.port_watcher = None
+
+    def run(self): # pylint: disable=too-many-branches
+        """
+        Run the event loop forever.
+        """
+        self.port_closer = PortCloser()
+        # Start watching before the first scan, so no new ports are missed
+        self.port_watcher = make_port_watcher()
+        if self.port_watcher.fileno() is not None:
+            self.selector.register(self.port_watcher, selectors.EVENT_READ)
+        self.spin_up_cached_devices()
+        self.scan_for_new_devices()
+        next_rescan = time.time() + HOTPLUG_RESCAN_INTERVAL
+        while True:
+            self.send_instructions()
+            deadlines = [min(conn.identify_deadline, conn.next_ping)
+                         for conn in self.connections.values() if not conn.verified]
+            publish_deadline = self.publisher.deadline()
+            if publish_deadline is not None:
+                deadlines.append(publish_deadline)
+            watch_deadline = self.port_watcher.deadline()
+            if watch_deadline is not None:
+                deadlines.append(watch_deadline)
+            timeout = min([next_rescan] + deadlines) - time.time()
+            for key, events in self.selector.select(max(timeout, 0)):
+                if key.fileobj is self.pipe:
+                    self.handle_pipe()
+                    continue
+                if key.fileobj is self.port_watcher:
+                    self.handle_port_changes()
+                    continue
+                conn = key.data
+                try:
+                    if events & selectors.EVENT_READ:
+                        self.handle_read(conn)
+                    if events & selectors.EVENT_WRITE:
+                        self.flush(conn)
+                except OSError:
+                    self.disconnect(conn)
+
+            now = time.time()
+            publish_deadline = self.publisher.deadline()
+            if publish_deadline is not None and now >= publish_deadline:
+                self.publisher.publish()
+            for conn in list(self.connections.values()):
+                if conn.verified:
+                    continue
+                if now >= conn.identify_deadline:
+                    # Not a smart sensor, or it's not responding
+                    self.disconnect(conn)
+                elif now >= conn.next_ping:
+                    conn.instructions.append(("ping", []))
+                    conn.next_ping += IDENTIFY_RETRY_INTERVAL
+            if watch_deadline is not None and now >= watch_deadline:
+                self.handle_port_changes()
+            if now >= next_rescan:
+                self.scan_for_new_devices()
+                next_rescan = time.time() + HOTPLUG_RESCAN_INTERVAL
+
+    def spin_up_cached_devices(self):
+        """
+        Start treating each port as the device that was on it last time
+        (see `load_device_cache`), until it answers otherwise.
+        """
+        cached = load_device_cache()
+        serials, _ = open_serial_ports(cached)
+        deadline = time.time() + IDENTIFY_TIMEOUT
+        for serial_port in serials:
+            uid = cached[serial_port.name]
+            if uid in self.devices:
+                serial_port.close()
+                continue
+            self.identify(self.add_connection(serial_port, deadline), uid)
+
+    def scan_for_new_devices(self):
+        """
+        Open ports that aren't in use yet and ping them to see
+        which have smart sensors.
+        """
+        serials, _ = get_working_serial_ports(self.connections.keys())
+        deadline = time.time() + IDENTIFY_TIMEOUT
+        for serial_port in serials:
+            conn = self.add_connection(serial_port, deadline)
+            conn.instructions.append(("ping", []))
+
+    def handle_port_changes(self):
+        """
+        Drop the connections to ports that have gone away, and scan
+        for devices if new ports have appeared.
+        """
+        added, removed = self.port_watcher.changes()
+        for port in removed:
+            conn = self.connections.get(port)
+            if conn is not None:
+                self.disconnect(conn)
+        if added:
+            self.scan_for_new_devices()
+
+    def add_connection(self, serial_port, identify_deadline):
+        """
+        Start running SERIAL_PORT, which has until IDENTIFY_DEADLINE
+        to answer a ping.
+
+        Returns:
+            The new SerialConnection.
+        """
+        conn = SerialConnection(serial_port, identify_deadline)
+        self.connections[serial_port.name] = conn
+        self.selector.register(conn.fd, selectors.EVENT_READ, conn)
+        return conn
+
+    def handle_pipe(self):
+        """
+        Forward instructions from the state manager to devices.
+        """
+        while self.pipe.poll():
+            instruction, args = self.pipe.recv()
+            if instruction == "enumerate_all":
+                for conn in self.devices.values():
+                    conn.instructions.append(("ping", []))
+            elif instruction == "disable_all":
+                for conn in self.devices.values():
+                    # Anything the device hasn't read yet is out of date
+                    discard_output(conn.serial_port)
+                    del conn.out_buffer[:]
+                    conn.instructions.append(("disable", []))
+            elif instruction == "timestamp_down":
+                self.state_queue.put(("timestamp_up", args + [time.monotonic()]))
+            elif instruction == "write_devices":
+                for uid, params_and_values in args[0].items():
+                    if uid in self.devices:
+                        self.devices[uid].instructions.append(
+                            ("write", [uid, params_and_values]))
+            elif instruction in self.DEVICE_INSTRUCTIONS and args[0] in self.devices:
+                self.devices[args[0]].instructions.append(
+                    (self.DEVICE_INSTRUCTIONS[instruction], args))
+
+    def handle_read(self, conn):
+        """
+        Read whatever is available from CONN, and handle any complete packets.
+        """
+        try:
+            data = os.read(conn.fd, 4096)
+        except BlockingIOError:
+            return
+        if not data:
+            # Readable but empty means the device went away
+            raise OSError("device disconnected")
+        conn.decoder.feed(data)
+        for packet in conn.decoder:
+            try:
+                self.handle_packet(conn, packet)
+            except hm.PAYLOAD_ERRORS:
+                # A garbled packet; the next one may well be fine
+                continue
+
+    def handle_packet(self, conn, packet):
+        """
+        Handle a PACKET from CONN.
+        """
+        message_type = packet.get_message_id()
+        if message_type == hm.MESSAGE_TYPES["SubscriptionResponse"]:
+            params, delay, uid = hm.parse_subscription_response(packet)
+            if conn.uid is None:
+                self.identify(conn, uid)
+                self.save_device_cache()
+            elif uid != conn.uid:
+                # Not the device we thought was here (see load_device_cache)
+                raise OSError("unexpected device")
+            else:
+                if not conn.verified:
+                    conn.verified = True
+                    print("Identified device %d on %s in %.1f ms"
+                          % (uid, conn.serial_port.name,
+                             1000 * (time.time() - conn.identify_start)))
+                self.publisher.reset(uid, "device_subscribed", [uid, delay, params])
+        elif not conn.verified:
+            return
+        elif message_type == hm.MESSAGE_TYPES["DeviceData"]:
+            params_and_values = hm.parse_device_data(packet, hm.uid_to_device_id(conn.uid))
+            self.publisher.update(conn.uid, params_and_values)
+        elif message_type == hm.MESSAGE_TYPES["HeartBeatRequest"]:
+            conn.instructions.append(("heartResp", [conn.uid]))
+
+    def identify(self, conn, uid):
+        """
+        Start treating CONN as the device with UID.
+        """
+        conn.uid = uid
+        self.devices[uid] = conn
+        # Tell the device to stop sending data, then ping it
+        # so the state manager hears about it
+        conn.instructions.append(("subscribe", [uid, 0, []]))
+        conn.instructions.append(("ping", []))
+        conn.identify_deadline = time.time() + IDENTIFY_TIMEOUT
+        conn.next_ping = time.time() + IDENTIFY_RETRY_INTERVAL
+
+    def save_device_cache(self):
+        """
+        Remember which port each device is on.
+        """
+        save_device_cache({uid: conn.serial_port.name for uid, conn in self.devices.items()})
+
+    def send_instructions(self):
+        """
+        Frame pending instructions for every port and start writing them out.
+
+        Only up to MAX_OUT_BUFFER bytes are framed ahead of what a port
+        has taken, so instructions wait in order of priority (see
+        `InstructionLanes`) rather than behind a long buffer, and a
+        disable never waits for more than that.
+        """
+        for conn in list(self.connections.values()):
+            if not conn.instructions or len(conn.out_buffer) >= MAX_OUT_BUFFER:
+                continue
+            while conn.instructions and len(conn.out_buffer) < MAX_OUT_BUFFER:
+                instruction, args = conn.instructions.pop()
+                send_instruction(conn, instruction, args, self.frame)
+            try:
+                self.flush(conn)
+            except OSError:
+                self.disconnect(conn)
+
+    def flush(self, conn):
+        """
+        Write as much of CONN's output buffer as the port will take without
+        blocking, and only watch for writability while some is left.
+        """
+        if conn.out_buffer:
+            try:
+                written = os.write(conn.fd, conn.out_buffer)
+                del conn.out_buffer[:written]
+            except BlockingIOError:
+                pass
+        events = selectors.EVENT_READ
+        if conn.out_buffer:
+            events |= selectors.EVENT_WRITE
+        if self.selector.get_key(conn.fd).events != events:
+            self.selector.modify(conn.fd, events, conn)
+
+    def disconnect(self, conn):
+        """
+        Stop using CONN, and close it in the background.
+        """
+        if self.connections.get(conn.serial_port.name) is not conn:
+            return
+        del self.connections[conn.serial_port.name]
+        self.selector.unregister(conn.fd)
+        if conn.uid is not None and self.devices.get(conn.uid) is conn:
+            del self.devices[conn.uid]
+            if conn.verified:
+                self.publisher.reset(conn.uid, "device_disconnected", [conn.uid])
+            self.save_device_cache()
+        self.port_closer.close(conn.serial_port)
@@ -0,0 +1,223 @@
+"""
+A table of sensor values in shared memory.
+
+The hibike process writes values into the table as they arrive from
+devices, and other processes (student code) read them straight out of
+it, without going through the state manager.
+"""
+import multiprocessing
+import struct
+import time
+
+# pylint: disable=import-error
+import hibike_message as hm
+
+__all__ = ["SensorTable"]
+
+
+# Number of devices the table has room for
+MAX_DEVICES = 64
+
+# Every slot starts with a header:
+#   sequence number (odd while the slot is being written),
+#   whether the slot is in use,
+#   device type, year and id of the device's UID,
+#   bitmask of the params that have a value,
+#   `time.monotonic` time of the last update
+SLOT_HEADER = struct.Struct("<I?HBQHd")
+SEQUENCE = struct.Struct("<I")
+VALID_OFFSET = SLOT_HEADER.size - 10
+VALID = struct.Struct("<Hd")
+
+
+def make_layouts():
+    """
+    Lay out the values of every device type, in param number order.
+
+    Returns:
+        A tuple of ({device_id: {param: (bit, offset, struct)}},
+        size of the largest layout in bytes).
+    """
+    layouts = {}
+    largest = 0
+    for device_id, device in hm.DEVICES.items():
+        layout = {}
+        offset = SLOT_HEADER.size
+        for param in device["params"]:
+            codec = struct.Struct("<" + hm.PARAM_TYPES[param["type"]])
+            layout[param["name"]] = (1 << param["number"], offset, codec)
+            offset += codec.size
+        layouts[device_id] = layout
+        largest = max(largest, offset - SLOT_HEADER.size)
+    return layouts, largest
+
+
+LAYOUTS, LARGEST_LAYOUT = make_layouts()
+# Rounded up to keep slots 8-byte aligned
+SLOT_SIZE = (SLOT_HEADER.size + LARGEST_LAYOUT + 7) & ~7
+
+
+class SensorTable:
+    """
+    Fixed-size records of device values, one slot per device, in a
+    shared buffer.
+
+    Create the table before starting the processes that use it, and pass
+    it to them as an argument. Only one process may write to the table,
+    and only one thread at a time; any number of processes can read.
+
+    Each slot is guarded by a sequence lock: the writer makes the slot's
+    sequence number odd while changing it, and readers retry until they
+    see the same even number before and after reading.
+    """
+    def __init__(self, max_devices=MAX_DEVICES, buffer=None):
+        if buffer is None:
+            buffer = multiprocessing.RawArray("B", max_devices * SLOT_SIZE)
+        self._buffer = buffer
+        self._view = memoryview(buffer).cast("B")
+        self.max_devices = len(self._view) // SLOT_SIZE
+        # UID: slot offset. For the writer, the slots it has handed out;
+        # for readers, where each UID was last seen.
+        self._slots = {}
+
+    def __getstate__(self):
+        return self._buffer
+
+    def __setstate__(self, buffer):
+        self.__init__(buffer=buffer)
+
+    def add(self, uid):
+        """
+        Give the device at UID a slot, with no values.
+
+        Returns:
+            Whether the device has a slot; False if the table is full.
+        """
+        if uid in self._slots:
+            return True
+        used = set(self._slots.values())
+        for base in range(0, self.max_devices * SLOT_SIZE, SLOT_SIZE):
+            if base not in used:
+                break
+        else:
+            return False
+        seq, = SEQUENCE.unpack_from(self._view, base)
+        SEQUENCE.pack_into(self._view, base, seq + 1)
+        SLOT_HEADER.pack_into(self._view, base, seq + 1, True, hm.get_device_type(uid),
+                              hm.get_year(uid), hm.get_id(uid), 0, 0)
+        SEQUENCE.pack_into(self._view, base, seq + 2)
+        self._slots[uid] = base
+        return True
+
+    def remove(self, uid):
+        """
+        Free the slot of the device at UID.
+        """
+        base = self._slots.pop(uid, None)
+        if base is None:
+            return
+        seq, = SEQUENCE.unpack_from(self._view, base)
+        SEQUENCE.pack_into(self._view, base, seq + 1)
+        SLOT_HEADER.pack_into(self._view, base, seq + 1, False, 0, 0, 0, 0, 0)
+        SEQUENCE.pack_into(self._view, base, seq + 2)
+
+    def update(self, uid, params_and_values):
+        """
+        Write PARAMS_AND_VALUES from the device at UID into its slot,
+        giving it one if it doesn't have one yet.
+
+        Returns:
+            Whether the values were written; False if the table is full.
+        """
+        base = self._slots.get(uid)
+        if base is None:
+            if not self.add(uid):
+                return False
+            base = self._slots[uid]
+        view = self._view
+        layout = LAYOUTS[hm.get_device_type(uid)]
+        seq, = SEQUENCE.unpack_from(view, base)
+        SEQUENCE.pack_into(view, base, seq + 1)
+        valid, _ = VALID.unpack_from(view, base + VALID_OFFSET)
+        for param, value in params_and_values:
+            bit, offset, codec = layout[param]
+            codec.pack_into(view, base + offset, value)
+            valid |= bit
+        VALID.pack_into(view, base + VALID_OFFSET, valid, time.monotonic())
+        SEQUENCE.pack_into(view, base, seq + 2)
+        return True
+
+    def _read_header(self, base):
+        """
+        Read the header of the slot at BASE consistently.
+
+        Returns:
+            A tuple of (sequence number, UID or None if the slot is free,
+            valid params bitmask, time of the last update).
+        """
+        while True:
+            seq, in_use, device_type, year, id_num, valid, updated = SLOT_HEADER.unpack_from(
+                self._view, base)
+            if seq & 1 or SEQUENCE.unpack_from(self._view, base)[0] != seq:
+                continue
+            uid = (device_type << 72) | (year << 64) | id_num if in_use else None
+            return seq, uid, valid, updated
+
+    def _find(self, uid):
+        """
+        The offset of the slot holding UID, or None if it isn't in the table.
+        """
+        base = self._slots.get(uid)
+        if base is not None and self._read_header(base)[1] == uid:
+            return base
+        self._slots.pop(uid, None)
+        for base in range(0, self.max_devices * SLOT_SIZE, SLOT_SIZE):
+            if self._read_header(base)[1] == uid:
+                self._slots[uid] = base
+                return base
+        return None
+
+    def __contains__(self, uid):
+        return self._find(uid) is not None
+
+    def get_value(self, uid, param):
+        """
+        Read PARAM of the device at UID.
+
+        Returns:
+            The value, or None if the device hasn't sent one yet.
+        Raises:
+            KeyError if the device isn't in the table.
+        """
+        base = self._find(uid)
+        if base is None:
+            raise KeyError(uid)
+        bit, offset, codec = LAYOUTS[hm.get_device_type(uid)][param]
+        view = self._view
+        while True:
+            seq, slot_uid, valid, _ = self._read_header(base)
+            if slot_uid != uid:
+                # The device went away and its slot was reused
+                base = self._find(uid)
+                if base is None:
+                    raise KeyError(uid)
+                continue
+            value, = codec.unpack_from(view, base + offset)
+            if SEQUENCE.unpack_from(view, base)[0] == seq:
+                return value if valid & bit else None
+
+    def get_update_time(self, uid):
+        """
+        Find out when the device at UID last had values written.
+
+        Returns:
+            The `time.monotonic` time of the last update, or None if
+            there hasn't been one.
+        Raises:
+            KeyError if the device isn't in the table.
+        """
+        base = self._find(uid)
+        if base is None:
+            raise KeyError(uid)
+        updated = self._read_header(base)[3]
+        return updated or None
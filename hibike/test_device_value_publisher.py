@@ -0,0 +1,70 @@
+"""
+Tests for DeviceValuePublisher.
+
+Run with `python3 -m unittest test_device_value_publisher` from this directory.
+"""
+import queue
+import unittest
+
+from hibike_process import DeviceValuePublisher
+
+
+class DeviceValuePublisherTest(unittest.TestCase):
+    """
+    Record values the way device threads do, and check what gets sent
+    to the state manager.
+    """
+    UID = 1
+
+    def setUp(self):
+        self.state_queue = queue.Queue()
+        self.publisher = DeviceValuePublisher(self.state_queue, min_interval=0)
+
+    def published(self):
+        """
+        Publish pending values, returning {uid: {param: value}} of what
+        was sent, or None if nothing was.
+        """
+        self.publisher.publish()
+        if self.state_queue.empty():
+            return None
+        command, args = self.state_queue.get_nowait()
+        self.assertEqual(command, "device_values")
+        return {uid: dict(params) for uid, params in args[0].items()}
+
+    def test_changes_published(self):
+        self.publisher.update(self.UID, [("x", 1), ("y", 2)])
+        self.assertEqual(self.published(), {self.UID: {"x": 1, "y": 2}})
+        self.publisher.update(self.UID, [("x", 1), ("y", 3)])
+        self.assertEqual(self.published(), {self.UID: {"y": 3}})
+
+    def test_unchanged_not_published(self):
+        self.publisher.update(self.UID, [("x", 1)])
+        self.published()
+        self.publisher.update(self.UID, [("x", 1)])
+        self.assertIsNone(self.published())
+        self.assertIsNone(self.publisher.deadline())
+
+    def test_return_to_published_value(self):
+        """
+        A value that changes and changes back before it's published
+        shouldn't leave the in-between value to be sent.
+        """
+        self.publisher.update(self.UID, [("x", 1)])
+        self.published()
+        self.publisher.update(self.UID, [("x", 2)])
+        self.publisher.update(self.UID, [("x", 1)])
+        self.assertIsNone(self.published())
+        self.publisher.update(self.UID, [("x", 2)])
+        self.assertEqual(self.published(), {self.UID: {"x": 2}})
+
+    def test_return_keeps_other_params(self):
+        self.publisher.update(self.UID, [("x", 1), ("y", 1)])
+        self.published()
+        self.publisher.update(self.UID, [("x", 2), ("y", 2)])
+        self.publisher.update(self.UID, [("x", 1)])
+        self.assertEqual(self.published(), {self.UID: {"y": 2}})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+"""
+Tests for PortCloser, using stand-ins for serial ports whose closes can
+be made to hang.
+
+Run with `python3 -m unittest test_port_closer` from this directory.
+"""
+import threading
+import time
+import unittest
+
+from device_helpers import PortCloser
+
+
+class FakePort:
+    """
+    Just enough of a serial port for PortCloser. Closing it waits for
+    `release` to be set.
+    """
+    fd = None
+
+    def __init__(self, name, hang=False):
+        self.name = name
+        self.release = threading.Event()
+        if not hang:
+            self.release.set()
+        self.closed = threading.Event()
+
+    def cancel_read(self):
+        pass
+
+    def cancel_write(self):
+        pass
+
+    def close(self):
+        self.release.wait()
+        self.closed.set()
+
+
+class PortCloserTest(unittest.TestCase):
+    """
+    Hand ports to a PortCloser and check when they're closed.
+    """
+    def setUp(self):
+        self.closer = PortCloser(workers=2, timeout=.1, report_interval=0)
+        self.hung = []
+
+    def tearDown(self):
+        for port in self.hung:
+            port.release.set()
+
+    def test_close(self):
+        port = FakePort("a")
+        self.closer.close(port)
+        self.assertTrue(port.closed.wait(1))
+        time.sleep(.05)
+        stats = self.closer.stats()
+        self.assertEqual(stats["closed"], 1)
+        self.assertEqual(stats["timed_out"], 0)
+
+    def test_hung_close_not_blocking(self):
+        hung = FakePort("hung", hang=True)
+        self.hung.append(hung)
+        self.closer.close(hung)
+        time.sleep(.05)
+        port = FakePort("b")
+        self.closer.close(port)
+        self.assertTrue(port.closed.wait(1))
+        self.assertFalse(hung.closed.is_set())
+        hung.release.set()
+        self.assertTrue(hung.closed.wait(1))
+
+    def test_running_threads_time_out(self):
+        stop = threading.Event()
+        thread = threading.Thread(target=stop.wait)
+        thread.start()
+        try:
+            port = FakePort("c")
+            start = time.time()
+            self.closer.close(port, [thread])
+            self.assertTrue(port.closed.wait(1))
+            self.assertLess(time.time() - start, .5)
+            time.sleep(.05)
+            self.assertEqual(self.closer.stats()["timed_out"], 1)
+        finally:
+            stop.set()
+            thread.join()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+"""
+Tests for PortWatcher, using pseudo-terminal pairs as serial ports.
+
+Run with `python3 -m unittest test_port_watcher` from this directory.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from port_watcher import PortWatcher, LIBC
+
+
+class PortWatcherTest(unittest.TestCase):
+    """
+    Create and remove ptys listed in a file, the way virtual devices
+    are listed in virtual_devices.txt, and check they're noticed.
+    """
+    INOTIFY = True
+
+    def setUp(self):
+        if self.INOTIFY and LIBC is None:
+            self.skipTest("inotify isn't available")
+        self.directory = tempfile.mkdtemp()
+        self.port_list = os.path.join(self.directory, "ports.txt")
+        self.ptys = []
+        self.watcher = PortWatcher(self.list_ports, [self.directory],
+                                   poll_interval=.05, inotify=self.INOTIFY)
+
+    def tearDown(self):
+        self.watcher.close()
+        for master, slave in self.ptys:
+            os.close(master)
+            os.close(slave)
+        shutil.rmtree(self.directory)
+
+    def list_ports(self):
+        """
+        The ports in the port list file.
+        """
+        try:
+            with open(self.port_list) as port_list:
+                return port_list.read().split()
+        except IOError:
+            return []
+
+    def write_port_list(self, ports):
+        """
+        Replace the port list file with PORTS.
+        """
+        with open(self.port_list, "w") as port_list:
+            port_list.write("\n".join(ports))
+
+    def open_pty(self):
+        """
+        Create a pty pair, returning the name of the slave end.
+        """
+        master, slave = os.openpty()
+        self.ptys.append((master, slave))
+        return os.ttyname(slave)
+
+    def close_pty(self, name):
+        """
+        Close the pty pair with slave NAME, which removes it.
+        """
+        for master, slave in self.ptys:
+            if os.ttyname(slave) == name:
+                self.ptys.remove((master, slave))
+                os.close(master)
+                os.close(slave)
+                return
+
+    def wait_for_changes(self):
+        """
+        Returns:
+            The ports that appeared and went away, within a second.
+        """
+        return self.watcher.wait(1)
+
+    def test_nothing_changed(self):
+        self.assertEqual(self.watcher.wait(.2), (set(), set()))
+
+    def test_port_created(self):
+        port = self.open_pty()
+        self.write_port_list([port])
+        self.assertEqual(self.wait_for_changes(), ({port}, set()))
+        self.assertEqual(self.watcher.ports, {port})
+
+    def test_port_removed(self):
+        ports = [self.open_pty(), self.open_pty()]
+        self.write_port_list(ports)
+        self.assertEqual(self.wait_for_changes(), (set(ports), set()))
+        self.close_pty(ports[0])
+        self.assertEqual(self.wait_for_changes(), (set(), {ports[0]}))
+        self.assertEqual(self.watcher.ports, {ports[1]})
+
+    def test_listed_before_created(self):
+        # A port that doesn't exist yet isn't reported until it does
+        port = self.open_pty()
+        self.close_pty(port)
+        self.write_port_list([port])
+        self.assertEqual(self.watcher.wait(.2), (set(), set()))
+        self.assertEqual(self.open_pty(), port)
+        self.assertEqual(self.wait_for_changes(), ({port}, set()))
+
+    def test_unlisted_ports_ignored(self):
+        self.write_port_list([])
+        self.watcher.wait(.2)
+        self.open_pty()
+        self.assertEqual(self.watcher.wait(.2), (set(), set()))
+
+
+class PollingPortWatcherTest(PortWatcherTest):
+    """
+    The same, listing the ports every so often instead of using inotify.
+    """
+    INOTIFY = False
+
+    def test_polls(self):
+        self.assertIsNone(self.watcher.fileno())
+        self.assertIsNotNone(self.watcher.deadline())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+"""
+Tests for SelectorEngine, with simulated devices on pseudo-terminals.
+
+Run with `python3 -m unittest test_selector_engine` from this directory.
+"""
+import multiprocessing
+import queue
+import tempfile
+import threading
+import time
+import unittest
+
+from benchmark import SimulatedDevices
+import hibike_message as hm
+import hibike_process
+from selector_engine import SelectorEngine
+
+
+class SelectorEngineTest(unittest.TestCase):
+    """
+    Run an engine on its own thread against two simulated devices.
+    """
+    def setUp(self):
+        self.devices = SimulatedDevices(2)
+        self.devices.thread.start()
+        self.port_list = tempfile.NamedTemporaryFile("w", suffix=".txt")
+        self.port_list.write("\n".join(self.devices.ports))
+        self.port_list.flush()
+        # Left in place afterwards, since the engine can't be stopped, and
+        # would otherwise save the device cache when the devices go away
+        hibike_process.VIRTUAL_DEVICE_CONFIG_FILE = self.port_list.name
+        hibike_process.DEVICE_CACHE_FILE = ""
+        self.state_queue = queue.Queue()
+        self.to_engine, from_child = multiprocessing.Pipe()
+        engine = SelectorEngine(self.state_queue, from_child)
+        self.engine_thread = threading.Thread(target=engine.run)
+        self.engine_thread.daemon = True
+        self.engine_thread.start()
+
+    def tearDown(self):
+        self.devices.close()
+        self.port_list.close()
+
+    def wait_for(self, command, uids, timeout=5):
+        """
+        Wait until COMMAND has been sent to the state manager for every
+        UID in UIDS.
+        """
+        waiting = set(uids)
+        deadline = time.time() + timeout
+        while waiting:
+            remaining = deadline - time.time()
+            self.assertGreater(remaining, 0, "no %s for %s" % (command, waiting))
+            try:
+                sent, args = self.state_queue.get(timeout=remaining)
+            except queue.Empty:
+                continue
+            if sent != command:
+                continue
+            if command == "device_values":
+                waiting -= set(args[0])
+            else:
+                waiting.discard(args[0])
+
+    def test_garbled_packet(self):
+        """
+        A packet with a good checksum but a payload that doesn't match its
+        params is dropped, without stopping the engine.
+        """
+        states = self.devices.states
+        uids = [state["uid"] for state in states]
+        self.wait_for("device_subscribed", uids)
+        for uid in uids:
+            self.to_engine.send(["subscribe_device", [uid, 5, ["natsuki"]]])
+        self.wait_for("device_values", uids)
+        # Three params, but a value for only one of them
+        garbled = hm.HibikeMessage(hm.MESSAGE_TYPES["DeviceData"], bytearray(b"\x07\x00\x01"))
+        with self.assertRaises(hm.PAYLOAD_ERRORS):
+            hm.parse_device_data(garbled, self.devices.DEVICE_ID)
+        self.devices.send(states[0], garbled)
+        time.sleep(.1)
+        self.assertTrue(self.engine_thread.is_alive())
+        while not self.state_queue.empty():
+            self.state_queue.get_nowait()
+        self.wait_for("device_values", uids)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,3 +1,5 @@
+import errno
+import os
 import socket
 import threading
 import time
@@ -13,10 +15,29 @@ UDP_SEND_PORT = 1235
 UDP_RECV_PORT = 1236
 TCP_PORT = 1234
 
-TCP_HZ = 5.0
-# Only for UDPSend Process
-PACKAGER_HZ = 5.0
-SOCKET_HZ = 5.0
+TCP_HZ = float(os.environ.get("RUNTIME_TCP_HZ", 5.0))
+
+# Only for UDPSend Process. Rates (per second) that telemetry is sent to Dawn at, for
+# each rate class; the robot state is always in the fast class.
+TELEMETRY_HZ = {
+    "fast": float(os.environ.get("RUNTIME_TELEMETRY_FAST_HZ", 10.0)),
+    "normal": float(os.environ.get("RUNTIME_TELEMETRY_HZ", 5.0)),
+    "slow": float(os.environ.get("RUNTIME_TELEMETRY_SLOW_HZ", 1.0)),
+}
+# Device type: rate class, for devices that aren't in the normal class
+TELEMETRY_RATE_CLASSES = {
+    "ServoControl": "fast",
+    "YogiBear": "fast",
+    "BatteryBuzzer": "slow",
+}
+# Lowest rate (per second) that sending falls back to while packets are being lost
+TELEMETRY_MIN_HZ = float(os.environ.get("RUNTIME_TELEMETRY_MIN_HZ", 1.0))
+# Number of sends that loss is measured over before the rate is adjusted
+TELEMETRY_LOSS_WINDOW = 10
+# Fraction of a window's sends that can be lost before the rate is halved; below it, the
+# rate goes back up by TELEMETRY_RECOVER_HZ per window
+TELEMETRY_LOSS_THRESHOLD = .1
+TELEMETRY_RECOVER_HZ = 1.0
 
 
 @unique # pylint: disable=invalid-name
@@ -54,6 +75,170 @@ class TwoBuffer():
         return self.data[self.get_index]
 
 
+class TelemetryBuilder():
+    """Keeps a RuntimeData proto for Dawn up to date with changes to the robot's state.
+
+    The message persists between updates: each device has a SensorData entry, and each of
+    its params a ParamValue entry, which are changed in place as values change. The
+    message is only serialized again when something in it has changed.
+    """
+
+    # Type of a param value: the ParamValue field it goes in
+    VALUE_FIELDS = {bool: "bool_value", float: "float_value", int: "int_value"}
+
+    def __init__(self):
+        self.message = runtime_pb2.RuntimeData()
+        # UID: {param: value}, for every device in the message
+        self.devices = {}
+        # UID: (SensorData, {param: ParamValue}), for every device in the message
+        self.entries = {}
+        self.serialized = None
+
+    def reset(self):
+        """Empty the message.
+        """
+        self.message.Clear()
+        self.devices = {}
+        self.entries = {}
+        self.serialized = None
+
+    def update(self, robot_state, changed, removed):
+        """Set the robot state to ROBOT_STATE, set the params of the devices in CHANGED
+        ({uid: {param: value}}), and remove the devices in REMOVED.
+        """
+        rebuild = any(uid in self.devices for uid in removed) or any(
+            uid in self.devices and any(params.get(param) is None
+                                        for param, value in self.devices[uid].items()
+                                        if value is not None)
+            for uid, params in changed.items())
+        if rebuild:
+            # Entries can't be removed from the middle of a message cheaply, so if a device
+            # or a param value went away, start over
+            devices = self.devices
+            for uid in removed:
+                devices.pop(uid, None)
+            devices.update(changed)
+            changed = devices
+            self.reset()
+        if self.message.robot_state != robot_state:
+            self.message.robot_state = robot_state
+            self.serialized = None
+        for uid, params in changed.items():
+            self.update_device(uid, params)
+
+    def update_device(self, uid, params):
+        """Set the params of the device at UID to PARAMS ({param: value}), none of which
+        may have gone from having a value to None.
+        """
+        old_params = self.devices.get(uid, {})
+        if uid not in self.entries:
+            self.serialized = None
+            sensor = self.message.sensor_data.add()
+            sensor.uid = str(uid)
+            sensor.device_type = SENSOR_TYPE[uid >> 72]
+            self.entries[uid] = (sensor, {})
+        sensor, param_values = self.entries[uid]
+        for param, value in params.items():
+            if value is None:
+                continue
+            param_value = param_values.get(param)
+            if param_value is None:
+                param_value = sensor.param_value.add()
+                param_value.param = param
+                param_values[param] = param_value
+            else:
+                old_value = old_params.get(param)
+                if old_value == value and type(old_value) is type(value):
+                    continue
+            self.set_param_value(param_value, value)
+            self.serialized = None
+        self.devices[uid] = params
+
+    def set_param_value(self, param_value, value):
+        """Put VALUE into the field of PARAM_VALUE for its type, or none if it doesn't fit.
+        """
+        field = self.VALUE_FIELDS.get(type(value))
+        if field is None:
+            for value_type, type_field in self.VALUE_FIELDS.items():
+                if isinstance(value, value_type):
+                    field = type_field
+                    break
+        try:
+            if field is None:
+                raise TypeError(value)
+            setattr(param_value, field, value)
+        except (TypeError, ValueError):
+            param_value.ClearField("kind")
+
+    def serialize(self):
+        """Returns the message, serialized.
+        """
+        if self.serialized is None:
+            self.serialized = self.message.SerializeToString()
+        return self.serialized
+
+
+class TelemetryScheduler():
+    """Decides when each rate class of telemetry is due to be sent to Dawn, and slows
+    sending down while packets are being lost.
+
+    The fast class is sent at the current rate, which starts at its configured rate. The
+    other classes are sent at their own rates, but never faster than the current rate.
+    Every send is recorded; when more than TELEMETRY_LOSS_THRESHOLD of a window of them
+    were lost, the current rate is halved (down to TELEMETRY_MIN_HZ), and otherwise it
+    goes back up towards the configured rate.
+    """
+
+    def __init__(self, rates=None):
+        self.rates = dict(TELEMETRY_HZ if rates is None else rates)
+        self.max_hz = self.rates["fast"]
+        self.hz = self.max_hz
+        # Rate class: time it's next due
+        self.next_due = {rate_class: 0 for rate_class in self.rates}
+        self.sent = 0
+        self.lost = 0
+
+    def interval(self):
+        """Returns the time in seconds between sends at the current rate.
+        """
+        return 1.0 / self.hz
+
+    def due(self, now):
+        """Returns the set of rate classes due to be sent at NOW, and schedules them again.
+        """
+        due = set()
+        for rate_class, hz in self.rates.items():
+            next_due = self.next_due[rate_class]
+            if now >= next_due:
+                due.add(rate_class)
+                # Keep to the schedule, unless it's fallen behind
+                period = 1.0 / min(hz, self.hz)
+                next_due += period
+                self.next_due[rate_class] = next_due if next_due > now else now + period
+        return due
+
+    @staticmethod
+    def rate_class(uid):
+        """Returns the rate class of the device at UID.
+        """
+        return TELEMETRY_RATE_CLASSES.get(SENSOR_TYPE.get(uid >> 72), "normal")
+
+    def record_send(self, delivered):
+        """Record a send, and whether it was DELIVERED to the network.
+        """
+        self.sent += 1
+        if not delivered:
+            self.lost += 1
+        if self.sent < TELEMETRY_LOSS_WINDOW:
+            return
+        if self.lost > self.sent * TELEMETRY_LOSS_THRESHOLD:
+            self.hz = max(self.hz / 2, min(TELEMETRY_MIN_HZ, self.max_hz))
+        else:
+            self.hz = min(self.hz + TELEMETRY_RECOVER_HZ, self.max_hz)
+        self.sent = 0
+        self.lost = 0
+
+
 class AnsibleHandler():
     """Parent class for UDP Processes that spawns threads
 
@@ -99,12 +284,16 @@ class UDPSendClass(AnsibleHandler):
     UDPSend runs in its own process which is started in runtime.py, and spawns two
     threads from this process. One thread is for packaging, and one thread is for sending.
     The packaging thread pulls the current state from SM, and packages the sensor data
-    into a proto. It shares the data to the send thread via a TwoBuffer. The send thread
-    sends the data over a UDP socket to Dawn on the UDP_SEND_PORT
+    into a proto. It shares the data to the send thread via a TwoBuffer, and wakes the send
+    thread up as soon as it's done. The send thread sends the data over a UDP socket to
+    Dawn on the UDP_SEND_PORT. How often this happens is up to a TelemetryScheduler.
     """
 
     def __init__(self, badThingsQueue, stateQueue, pipe):
         self.send_buffer = TwoBuffer()
+        # Set when there is newly packaged data in send_buffer
+        self.packaged = threading.Event()
+        self.scheduler = TelemetryScheduler()
         packager_name = THREAD_NAMES.UDP_PACKAGER
         sock_send_name = THREAD_NAMES.UDP_SENDER
         stateQueue.put([SM_COMMANDS.SEND_ADDR, [PROCESS_NAMES.UDP_SEND_PROCESS]])
@@ -121,54 +310,45 @@ class UDPSendClass(AnsibleHandler):
     def package_data(self, bad_things_queue, state_queue, pipe):
         """Function run as a thread that packages data to be sent.
 
-        The robot's current state is received from the StateManager via the pipe and packaged
-        by the package function, defined internally. The packaged data is then placed
-        back into the TwoBuffer replacing the previous state.
+        What has changed in the robot's state since last time is received from the
+        StateManager via the pipe, and applied to a TelemetryBuilder, which keeps the
+        packaged state. Changes to devices whose rate class isn't due yet are held back
+        until it is. The packaged data is then placed back into the TwoBuffer
+        replacing the previous state, and the sender is told to send it.
         """
-        def package(state):
-            """Helper function that packages the current state.
-
-            Parses through the state dictionary in key value pairs, creates a new message in the
-            proto for each sensor, and adds corresponding data to each field. Currently only
-            supports a single limit_switch switch as the rest of the state is just test fields.
-            """
-            try:
-                proto_message = runtime_pb2.RuntimeData()
-                proto_message.robot_state = state['studentCodeState'][0]
-                for uid, values in state['hibike'][0]['devices'][0].items():
-                    sensor = proto_message.sensor_data.add()
-                    sensor.uid = str(uid)
-                    sensor.device_type = SENSOR_TYPE[uid >> 72]
-                    for param, value in values[0].items():
-                        if value[0] is None:
-                            continue
-                        param_value_pair = sensor.param_value.add()
-                        param_value_pair.param = param
-                        if isinstance(value[0], bool):
-                            param_value_pair.bool_value = value[0]
-                        elif isinstance(value[0], float):
-                            param_value_pair.float_value = value[0]
-                        elif isinstance(value[0], int):
-                            param_value_pair.int_value = value[0]
-                return proto_message.SerializeToString()
-            except Exception as e:
-                bad_things_queue.put(
-                    BadThing(
-                        sys.exc_info(),
-                        "UDP packager thread has crashed with error:" +
-                        str(e),
-                        event=BAD_EVENTS.UDP_SEND_ERROR,
-                        printStackTrace=True))
+        telemetry = TelemetryBuilder()
+        scheduler = self.scheduler
+        # The version of the state the state manager last sent; it only
+        # sends what has changed since then
+        version = None
+        # UID: {param: value}, for devices with changes that haven't been packaged yet
+        held = {}
         while True:
             try:
                 next_call = time.time()
-                state_queue.put([SM_COMMANDS.SEND_ANSIBLE, []])
-                raw_state = pipe.recv()
-                pack_state = package(raw_state)
-                self.send_buffer.replace(pack_state)
-                next_call += 1.0 / PACKAGER_HZ
+                due = scheduler.due(next_call)
+                state_queue.put([SM_COMMANDS.SEND_ANSIBLE, [version]])
+                version, full, robot_state, changed, removed = pipe.recv()
+                if full:
+                    held = {}
+                    telemetry.reset()
+                else:
+                    held.update(changed)
+                    for uid in removed:
+                        held.pop(uid, None)
+                    changed = {uid: params for uid, params in held.items()
+                               if uid not in telemetry.devices
+                               or scheduler.rate_class(uid) in due}
+                    for uid in changed:
+                        del held[uid]
+                telemetry.update(robot_state, changed, removed)
+                self.send_buffer.replace(telemetry.serialize())
+                self.packaged.set()
+                next_call += scheduler.interval()
                 time.sleep(max(next_call - time.time(), 0))
             except Exception as e:
+                # Start over with everything next time
+                version = None
                 bad_things_queue.put(
                     BadThing(
                         sys.exc_info(),
@@ -181,17 +361,25 @@ class UDPSendClass(AnsibleHandler):
         """Function run as a thread that sends a packaged state from the TwoBuffer
 
         The current state that has already been packaged is gotten from the
-        TwoBuffer, and is sent to Dawn via a UDP socket.
+        TwoBuffer as soon as the packager is done with it, and is sent to Dawn via a UDP
+        socket. Whether each send made it onto the network is recorded with the
+        scheduler: the socket doesn't block, so a full send queue counts as a lost
+        packet, as do errors from Dawn's end, like it not listening.
         """
         with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            connected = False
             while True:
                 try:
-                    next_call = time.time()
+                    self.packaged.wait()
+                    self.packaged.clear()
                     msg = self.send_buffer.get()
                     if msg != 0 and msg is not None and self.dawn_ip is not None:
-                        sock.sendto(msg, (self.dawn_ip, UDP_SEND_PORT))
-                    next_call += 1.0 / SOCKET_HZ
-                    time.sleep(max(next_call - time.time(), 0))
+                        if not connected:
+                            # Connected so that errors from Dawn's end are reported
+                            sock.connect((self.dawn_ip, UDP_SEND_PORT))
+                            connected = True
+                        self.scheduler.record_send(self.send_packet(sock, msg))
                 except Exception as e:
                     bad_things_queue.put(
                         BadThing(
@@ -201,6 +389,20 @@ class UDPSendClass(AnsibleHandler):
                             event=BAD_EVENTS.UDP_SEND_ERROR,
                             printStackTrace=True))
 
+    @staticmethod
+    def send_packet(sock, msg):
+        """Sends MSG over SOCK, returning whether it was sent.
+        """
+        try:
+            sock.send(msg)
+        except (BlockingIOError, ConnectionRefusedError):
+            return False
+        except OSError as e:
+            if e.errno not in (errno.ENOBUFS, errno.EHOSTUNREACH, errno.ENETUNREACH):
+                raise
+            return False
+        return True
+
 
 class UDPRecvClass(AnsibleHandler):
     """Class that receives data from Dawn via UDP
@@ -270,6 +472,9 @@ class UDPRecvClass(AnsibleHandler):
 
             Student code status is also stored in this dictionary. This dictionary is added to
             the overall state through the update method implemented in state manager.
+
+            Any other commands for the state manager are added to `commands`, to be sent
+            along with the dictionary.
             """
             unpackaged_data = {}
             received_proto = ansible_pb2.DawnData()
@@ -281,7 +486,7 @@ class UDPRecvClass(AnsibleHandler):
             if self.control_state is None or new_state != self.control_state:
                 self.control_state = received_proto.student_code_status
                 sm_state_command = self.sm_mapping[new_state]
-                self.state_queue.put([sm_state_command, []])
+                commands.append([sm_state_command, []])
             all_gamepad_dict = {}
             for gamepad in received_proto.gamepads:
                 gamepad_dict = {}
@@ -290,12 +495,14 @@ class UDPRecvClass(AnsibleHandler):
                 all_gamepad_dict[gamepad.index] = gamepad_dict
             unpackaged_data["gamepads"] = [all_gamepad_dict, time.time()]
             if received_proto.team_color != ansible_pb2.DawnData.NONE:
-                self.state_queue.put([SM_COMMANDS.SET_TEAM,
-                                      [self.team_color_mapping[received_proto.team_color]]])
+                commands.append([SM_COMMANDS.SET_TEAM,
+                                 [self.team_color_mapping[received_proto.team_color]]])
             return unpackaged_data
 
+        commands = []
         unpackaged_data = unpackage(self.recv_buffer.get())
-        self.state_queue.put([SM_COMMANDS.RECV_ANSIBLE, [unpackaged_data]])
+        commands.append([SM_COMMANDS.RECV_ANSIBLE, [unpackaged_data]])
+        put_commands(self.state_queue, commands)
 
     def start(self):
         """Overwrites start in parent class so it doesn't run in two threads
@@ -9,6 +9,7 @@ import filecmp
 import argparse
 import inspect
 import asyncio
+import threading
 
 import stateManager
 import studentAPI
@@ -21,7 +22,7 @@ ALL_PROCESSES = {}
 
 
 # pylint: disable=too-many-branches
-def runtime(test_name=""): # pylint: disable=too-many-statements
+def runtime(test_name="", trace_latency=False): # pylint: disable=too-many-statements
     test_mode = test_name != ""
     max_iter = 3 if test_mode else None
 
@@ -32,14 +33,26 @@ def runtime(test_name=""): # pylint: disable=too-many-statements
 
     bad_things_queue = multiprocessing.Queue()
     state_queue = multiprocessing.Queue()
+    add_hibike_path()
+    import sensor_table # pylint: disable=import-error
+    # Sensor values, written by hibike and read by student code
+    sensor_values = sensor_table.SensorTable()
+    # Latency histograms of sensor values, recorded by hibike, the state
+    # manager and student code
+    latency = None
+    if trace_latency:
+        import latency_trace # pylint: disable=import-error
+        latency = latency_trace.LatencyTrace()
+        threading.Thread(target=report_latency, args=(latency, bad_things_queue),
+                         daemon=True).start()
     spawn_process = process_factory(bad_things_queue, state_queue)
     restart_count = 0
     emergency_stopped = False
 
     try:
-        spawn_process(PROCESS_NAMES.STATE_MANAGER, start_state_manager)
+        spawn_process(PROCESS_NAMES.STATE_MANAGER, start_state_manager, latency)
         spawn_process(PROCESS_NAMES.UDP_RECEIVE_PROCESS, start_udp_receiver)
-        spawn_process(PROCESS_NAMES.HIBIKE, start_hibike)
+        spawn_process(PROCESS_NAMES.HIBIKE, start_hibike, sensor_values, latency)
         control_state = "idle"
         dawn_connected = False
 
@@ -80,23 +93,27 @@ def runtime(test_name=""): # pylint: disable=too-many-statements
                 elif new_bad_thing.event == BAD_EVENTS.ENTER_TELEOP and control_state != "teleop":
                     terminate_process(PROCESS_NAMES.STUDENT_CODE)
                     name = test_name or "teleop"
-                    spawn_process(PROCESS_NAMES.STUDENT_CODE, run_student_code, name, max_iter)
+                    spawn_process(PROCESS_NAMES.STUDENT_CODE, run_student_code, name, max_iter,
+                                  sensor_values, latency)
                     control_state = "teleop"
                     continue
                 elif new_bad_thing.event == BAD_EVENTS.ENTER_AUTO and control_state != "auto":
                     terminate_process(PROCESS_NAMES.STUDENT_CODE)
-                    spawn_process(PROCESS_NAMES.STUDENT_CODE, run_student_code, "autonomous")
+                    spawn_process(PROCESS_NAMES.STUDENT_CODE, run_student_code, "autonomous",
+                                  None, sensor_values, latency)
                     control_state = "auto"
                     continue
                 elif new_bad_thing.event == BAD_EVENTS.ENTER_IDLE and control_state != "idle":
                     control_state = "idle"
                     break
                 elif new_bad_thing.event == BAD_EVENTS.TIMESTAMP_UP:
-                    new_bad_thing.data.append(time.time())
-                    print(new_bad_thing.data)
+                    new_bad_thing.data.append(time.monotonic())
+                    print(format_timestamps(new_bad_thing.data))
+                    continue
                 elif new_bad_thing.event == BAD_EVENTS.TIMESTAMP_DOWN:
-                    timestamp = time.time()
+                    timestamp = time.monotonic()
                     state_queue.put([HIBIKE_COMMANDS.TIMESTAMP_DOWN, [timestamp]])
+                    continue
                 print(new_bad_thing.event)
                 non_test_mode_print(new_bad_thing.data)
                 if new_bad_thing.event in restartEvents:
@@ -110,10 +127,12 @@ def runtime(test_name=""): # pylint: disable=too-many-statements
             if test_mode:
                 state_queue.put([SM_COMMANDS.RESET, []])
             terminate_process(PROCESS_NAMES.STUDENT_CODE)
-            state_queue.put([SM_COMMANDS.SET_VAL, [
-                runtime_pb2.RuntimeData.STUDENT_STOPPED, ["studentCodeState"], False]])
-            state_queue.put([SM_COMMANDS.END_STUDENT_CODE, []])
-            state_queue.put([HIBIKE_COMMANDS.DISABLE, []])
+            put_commands(state_queue, [
+                [SM_COMMANDS.SET_VAL, [
+                    runtime_pb2.RuntimeData.STUDENT_STOPPED, ["studentCodeState"], False]],
+                [SM_COMMANDS.END_STUDENT_CODE, []],
+                [HIBIKE_COMMANDS.DISABLE, []],
+            ])
         non_test_mode_print(RUNTIME_CONFIG.DEBUG_DELIMITER_STRING.value)
         print("Funtime Runtime is done having fun.")
         print("TERMINATING")
@@ -124,7 +143,35 @@ def runtime(test_name=""): # pylint: disable=too-many-statements
         print("".join(traceback.format_tb(sys.exc_info()[2])))
 
 
-def run_student_code(bad_things_queue, state_queue, pipe, test_name="", max_iter=None): # pylint: disable=too-many-locals
+def report_latency(latency, bad_things_queue):
+    """
+    Print the histograms in LATENCY (a `latency_trace.LatencyTrace`) every
+    LATENCY_REPORT_INTERVAL seconds, and send a timestamp down to hibike
+    and back, to time the trip through the queues.
+    """
+    while True:
+        time.sleep(RUNTIME_CONFIG.LATENCY_REPORT_INTERVAL.value)
+        print(RUNTIME_CONFIG.DEBUG_DELIMITER_STRING.value)
+        print(latency.report() or "No sensor values yet")
+        bad_things_queue.put(BadThing(sys.exc_info(), None, event=BAD_EVENTS.TIMESTAMP_DOWN,
+                                      printStackTrace=False))
+
+
+def format_timestamps(timestamps):
+    """
+    Describe the trip a TIMESTAMP_DOWN took, given the `time.monotonic`
+    TIMESTAMPS it picked up on the way: runtime, state manager, hibike,
+    state manager and runtime again.
+    """
+    hops = ["runtime->state manager", "state manager->hibike",
+            "hibike->state manager", "state manager->runtime"]
+    return "Timestamp round trip: " + ", ".join(
+        "%s %.1f ms" % (hop, (end - start) * 1000)
+        for hop, start, end in zip(hops, timestamps, timestamps[1:]))
+
+
+def run_student_code(bad_things_queue, state_queue, pipe, test_name="", max_iter=None, # pylint: disable=too-many-locals,too-many-arguments
+                     sensor_values=None, latency=None):
     try:
         import signal # pylint: disable=redefined-outer-name,reimported
 
@@ -165,12 +212,13 @@ def run_student_code(bad_things_queue, state_queue, pipe, test_name="", max_iter
         ensure_is_function(test_name + "main", main_fn)
         ensure_not_overridden(studentCode, "Robot")
 
-        studentCode.Robot = studentAPI.Robot(state_queue, pipe)
+        studentCode.Robot = studentAPI.Robot(state_queue, pipe, sensor_values, latency)
         studentCode.Gamepad = studentAPI.Gamepad(state_queue, pipe)
         studentCode.Actions = studentAPI.Actions
         studentCode.print = studentCode.Robot._print # pylint: disable=protected-access
 
         check_timed_out(setup_fn)
+        put_commands(state_queue, studentCode.Robot._write_commands()) # pylint: disable=protected-access
 
         exception_cell = [None]
         clarify_coroutine_warnings(exception_cell)
@@ -184,12 +232,17 @@ def run_student_code(bad_things_queue, state_queue, pipe, test_name="", max_iter
                 studentCode.Gamepad._get_gamepad() # pylint: disable=protected-access
                 check_timed_out(main_fn)
 
+                # Send requests student code didn't wait for the replies to, and
+                # everything written to devices this tick
+                commands = studentCode.Robot._client.take_requests() # pylint: disable=protected-access
+                commands += studentCode.Robot._write_commands() # pylint: disable=protected-access
                 # Throttle sending print statements
                 if (exec_count % 5) == 0:
-                    studentCode.Robot._send_prints() # pylint: disable=protected-access
+                    commands += studentCode.Robot._print_commands() # pylint: disable=protected-access
 
                 sleep_time = max(next_call - loop.time(), 0.)
-                state_queue.put([SM_COMMANDS.STUDENT_MAIN_OK, []])
+                commands.append([SM_COMMANDS.STUDENT_MAIN_OK, []])
+                put_commands(state_queue, commands)
                 exec_count += 1
                 await asyncio.sleep(sleep_time)
             if exception_cell[0] is not None:
@@ -220,9 +273,10 @@ def run_student_code(bad_things_queue, state_queue, pipe, test_name="", max_iter
         bad_things_queue.put(BadThing(sys.exc_info(), str(e), event=BAD_EVENTS.STUDENT_CODE_ERROR))
 
 
-def start_state_manager(bad_things_queue, state_queue, runtime_pipe):
+def start_state_manager(bad_things_queue, state_queue, runtime_pipe, latency=None):
     try:
-        state_manager = stateManager.StateManager(bad_things_queue, state_queue, runtime_pipe)
+        state_manager = stateManager.StateManager(bad_things_queue, state_queue, runtime_pipe,
+                                                  latency)
         state_manager.start()
     except Exception as e:
         bad_things_queue.put(BadThing(sys.exc_info(), str(e), event=BAD_EVENTS.STATE_MANAGER_CRASH))
@@ -353,22 +407,27 @@ def test_success(test_file_name):
     return filecmp.cmp(expected_output, test_output)
 
 
-def start_hibike(bad_things_queue, state_queue, pipe):
+def add_hibike_path():
+    """Modify sys.path so we can find hibike.
+    """
+    path = os.path.dirname(os.path.abspath(__file__))
+    parent_path = path.rstrip("runtime")
+    hibike = os.path.join(parent_path, "hibike")
+    if hibike not in sys.path:
+        sys.path.insert(1, hibike)
+
+
+def start_hibike(bad_things_queue, state_queue, pipe, sensor_values=None, latency=None):
     # bad_things_queue - queue to runtime
     # state_queue - queue to stateManager
     # pipe - pipe from statemanager
-    def add_paths():
-        """Modify sys.path so we can find hibike.
-        """
-        path = os.path.dirname(os.path.abspath(__file__))
-        parent_path = path.rstrip("runtime")
-        hibike = os.path.join(parent_path, "hibike")
-        sys.path.insert(1, hibike)
-
+    # sensor_values - SensorTable for hibike to write device values into
+    # latency - LatencyTrace for hibike to record publishing delays in
     try:
-        add_paths()
+        add_hibike_path()
         import hibike_process # pylint: disable=import-error
-        hibike_process.hibike_process(bad_things_queue, state_queue, pipe)
+        hibike_process.hibike_process(bad_things_queue, state_queue, pipe,
+                                      sensor_table=sensor_values, latency_trace=latency)
     except Exception as e:
         bad_things_queue.put(BadThing(sys.exc_info(), str(e)))
 
@@ -438,8 +497,11 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser() # pylint: disable=invalid-name
     parser.add_argument("-t", "--test", nargs="*",
                         help="Run specified tests. If no arguments, run all tests.")
+    parser.add_argument("--trace-latency", action="store_true",
+                        help="Periodically print how long sensor values take to reach "
+                             "each part of runtime.")
     arguments = parser.parse_args() # pylint: disable=invalid-name
     if arguments.test is None:
-        runtime()
+        runtime(trace_latency=arguments.trace_latency)
     else:
         runtime_test(arguments.test)
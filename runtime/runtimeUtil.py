@@ -3,6 +3,7 @@ import traceback
 import multiprocessing
 import os
 import json
+from collections import namedtuple
 from enum import Enum, unique
 
 
@@ -15,6 +16,8 @@ class RUNTIME_CONFIG(Enum):
     VERSION_MAJOR               = 1
     VERSION_MINOR               = 1
     VERSION_PATCH               = 0
+    LATENCY_REPORT_INTERVAL     = 10 # Seconds between latency reports, with --trace-latency
+    STUDENT_WRITE_REFRESH       = 1 # Seconds before an unchanged device write is sent again
 
 @unique
 class BAD_EVENTS(Enum):
@@ -57,6 +60,7 @@ class HIBIKE_COMMANDS(Enum):
     ENUMERATE = "enumerate_all"
     SUBSCRIBE = "subscribe_device"
     WRITE     = "write_params"
+    WRITE_DEVICES = "write_devices"
     READ      = "read_params"
     DISABLE   = "disable_all"
     TIMESTAMP_DOWN = "timestamp_down"
@@ -105,6 +109,26 @@ class SM_COMMANDS(Enum):
     ENTER_AUTO          = ()
     END_STUDENT_CODE    = ()
     SET_TEAM            = ()
+    # A list of [command, args] to handle in order, so several commands
+    # can be sent in one message (see put_commands)
+    BATCH               = ()
+    # [request ID, [command, args]]: a command from student code whose
+    # reply is tagged with the request ID, so student code can send several
+    # before waiting for the replies (see studentAPI.ManagerClient). Tagged
+    # replies are sent together, as a list of [request ID, reply].
+    REQUEST             = ()
+
+
+def put_commands(state_queue, commands):
+    """
+    Put COMMANDS, a list of [command, args], on STATE_QUEUE as one
+    message, which the state manager handles in order.
+    """
+    if len(commands) == 1:
+        state_queue.put(commands[0])
+    elif commands:
+        state_queue.put([SM_COMMANDS.BATCH, commands])
+
 
 class BadThing:
     def __init__(self, exc_info, data, event=BAD_EVENTS.BAD_EVENT, printStackTrace=True):
@@ -164,5 +188,101 @@ class StudentAPITypeError(StudentAPIError):
 
 # Sensor type names are CamelCase, with the first letter capitalized as well
 CONFIG_FILE = open(os.path.join(os.path.dirname(__file__), '../hibike/hibikeDevices.json'), 'r')
-SENSOR_TYPE = {device_data["id"]: device_data["name"] for device_data in json.load(CONFIG_FILE)}
+DEVICES = json.load(CONFIG_FILE)
+SENSOR_TYPE = {device_data["id"]: device_data["name"] for device_data in DEVICES}
 SENSOR_TYPE[-1] = "runtime_version"
+
+# Params student code may read from each device type
+STUDENT_READ_PARAMS = {
+    "LimitSwitch": ["switch0", "switch1", "switch2"],
+    "LineFollower": ["left", "center", "right"],
+    "Potentiometer": ["pot0", "pot1", "pot2"],
+    "ServoControl": ["servo0", "servo1"],
+    "YogiBear": ["duty_cycle", "enc_pos", "enc_vel"],
+    "RFID": ["id", "tag_detect"],
+}
+# Params student code may write to each device type
+STUDENT_WRITE_PARAMS = {
+    "TeamFlag": ["led1", "led2", "led3", "led4"],
+    "ServoControl": ["servo0", "servo1"],
+    "YogiBear": ["duty_cycle", "pid_pos_setpoint", "pid_pos_kp", "pid_pos_ki",
+                 "pid_pos_kd", "current_thresh", "enc_pos"],
+}
+# Lowest and highest values student code may write to numeric params
+STUDENT_WRITE_BOUNDS = {
+    "servo0": (-1, 1),
+    "servo1": (-1, 1),
+    "duty_cycle": (-1, 1),
+    "pid_pos_setpoint": (-float("inf"), float("inf")),
+    "pid_pos_kp": (0, float("inf")),
+    "pid_pos_ki": (0, float("inf")),
+    "pid_pos_kd": (0, float("inf")),
+    "current_thresh": (2, 10),
+    "enc_pos": (0, 0),
+}
+# Params the state manager subscribes to on each device type
+SUBSCRIBE_PARAMS = {
+    "LimitSwitch": ["switch0", "switch1", "switch2"],
+    "LineFollower": ["left", "center", "right"],
+    "Potentiometer": ["pot0", "pot1", "pot2"],
+    "BatteryBuzzer": ["v_batt", "is_unsafe"],
+    "ServoControl": ["servo0", "servo1"],
+    "YogiBear": ["duty_cycle", "enc_pos", "enc_vel"],
+    "RFID": ["id", "tag_detect"],
+    "ExampleDevice": ["hazuki", "sapphire", "reina", "asuka"]
+}
+
+# How to check a value written to a param: the types it may have, its
+# bounds (None for bools), and the errors raised when it's out of them
+ParamCheck = namedtuple("ParamCheck", ["types", "low", "high", "type_error", "bounds_error"])
+# What can be done with a device type: its name, the params student code may
+# read and write ({param: ParamCheck}), the errors raised for other params,
+# and the params the state manager subscribes to
+DeviceParams = namedtuple("DeviceParams", ["name", "read", "write", "read_error",
+                                           "write_error", "subscribe"])
+
+
+def make_param_check(param):
+    """
+    Work out how to check values written to PARAM, a param of a device in
+    hibikeDevices.json.
+    """
+    if param["type"] == "bool":
+        return ParamCheck((bool,), None, None,
+                          "Invalid value type passed in, valid types for this param are: bool",
+                          None)
+    low, high = STUDENT_WRITE_BOUNDS[param["name"]]
+    return ParamCheck((float, int), low, high,
+                      "Invalid value type passed in, valid types for this param are: float",
+                      "Invalid value passed in, valid values for this param are: "
+                      + str(low) + " to " + str(high))
+
+
+def make_device_params():
+    """
+    Work out what can be done with every device type in hibikeDevices.json.
+
+    Returns:
+        A dict of device type ID: DeviceParams.
+    """
+    device_params = {}
+    for device_data in DEVICES:
+        name = device_data["name"]
+        params = {param["name"]: param for param in device_data["params"]}
+        read = STUDENT_READ_PARAMS.get(name, [])
+        write = STUDENT_WRITE_PARAMS.get(name, [])
+        device_params[device_data["id"]] = DeviceParams(
+            name,
+            frozenset(param for param in read if params[param]["read"]),
+            {param: make_param_check(params[param]) for param in write
+             if params[param]["write"]},
+            "Invalid param passed in, valid parameters for this device are: "
+            + ", ".join(read),
+            "Invalid param passed in, valid parameters for this device are: "
+            + ", ".join(write),
+            SUBSCRIBE_PARAMS.get(name))
+    return device_params
+
+
+# Device type ID: DeviceParams
+DEVICE_PARAMS = make_device_params()
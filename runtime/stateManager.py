@@ -1,5 +1,6 @@
 # pylint: disable=invalid-name
 # pylint: enable=invalid-name
+import queue
 import sys
 import time
 import runtime_pb2
@@ -7,35 +8,228 @@ import runtime_pb2
 from runtimeUtil import *
 
 
+class StateStore(object):
+    """
+    A tree of keys and values, indexed by path.
+
+    The tree is kept in the nested form the rest of runtime uses, where
+    every node is a [value, timestamp] list and a dict's value is
+    {key: node}. Every node is also indexed by the tuple of keys leading
+    to it, so getting or setting a value doesn't walk the tree, and
+    reading a subtree doesn't copy it.
+
+    Only the node written to is timestamped when it's written. The
+    timestamp of a dict, which is the newest of its own and everything's
+    under it, is brought up to date when it's read: writes just note
+    their timestamp against the dicts above them, stopping at one that
+    has already noted a timestamp at least as new.
+    """
+
+    def __init__(self):
+        # Path: node, for every node
+        self._nodes = {(): [{}, 0]}
+        # Paths of dict nodes
+        self._dicts = {()}
+        # Path of a dict: newest timestamp written under it since it was read
+        self._pending = {}
+        # Paths of nodes written, created or removed since `take_changes`
+        self._changes = set()
+
+    def load(self, tree, path=()):
+        """
+        Add the nested TREE ({key: [value, timestamp]}) under the dict at PATH.
+
+        A value that is a non-empty dict of [value, timestamp] lists
+        becomes a dict node; anything else becomes a leaf.
+        """
+        for key, (value, stamp) in tree.items():
+            child = path + (key,)
+            if isinstance(value, dict) and value and all(
+                    isinstance(item, list) and len(item) == 2 for item in value.values()):
+                self.create(child, stamp)
+                self.load(value, child)
+            else:
+                self.set(child, value, stamp, create=True)
+
+    def __contains__(self, path):
+        return path in self._nodes
+
+    def take_changes(self):
+        """
+        Returns:
+            The set of paths of nodes that have been written, created or
+            removed since the last call.
+        """
+        changes = self._changes
+        self._changes = set()
+        return changes
+
+    def get(self, path):
+        """
+        Returns:
+            The value of the node at PATH; for a dict, its nested form.
+        Raises:
+            KeyError if there is no node at PATH.
+        """
+        node = self._nodes[path]
+        if path in self._dicts:
+            depth = len(path)
+            for pending in [pending for pending in self._pending if pending[:depth] == path]:
+                self._refresh(pending)
+        return node[0]
+
+    def timestamp(self, path):
+        """
+        Returns:
+            When the node at PATH, or anything under it, was last written.
+        Raises:
+            KeyError if there is no node at PATH.
+        """
+        node = self._nodes[path]
+        if path in self._pending:
+            self._refresh(path)
+        return node[1]
+
+    def set(self, path, value, stamp=None, create=False):
+        """
+        Make the node at PATH a leaf holding VALUE, written at STAMP
+        (by default, now). A dict there is replaced, along with
+        everything under it.
+
+        Raises:
+            KeyError if there is no node at PATH (unless CREATE is set),
+            or its parent isn't a dict.
+        """
+        node = self._nodes.get(path)
+        if node is None:
+            if not create or path[:-1] not in self._dicts:
+                raise KeyError(path)
+            node = [value, stamp]
+            self._nodes[path[:-1]][0][path[-1]] = node
+            self._nodes[path] = node
+        elif path in self._dicts:
+            self._forget(path)
+        if stamp is None:
+            stamp = time.time()
+        node[0] = value
+        node[1] = stamp
+        self._touch(path[:-1], stamp)
+        self._changes.add(path)
+
+    def create(self, path, stamp=None):
+        """
+        Make sure there is a node at PATH, adding empty dicts for any keys
+        that are missing, and mark it written at STAMP (by default, now).
+
+        Returns:
+            None, or the index into PATH of the first key that would have
+            to go under a leaf.
+        """
+        if stamp is None:
+            stamp = time.time()
+        for index in range(len(path)):
+            child = path[:index + 1]
+            if child in self._nodes:
+                continue
+            parent = path[:index]
+            if parent not in self._dicts:
+                return index
+            node = [{}, stamp]
+            self._nodes[parent][0][path[index]] = node
+            self._nodes[child] = node
+            self._dicts.add(child)
+        if path in self._dicts:
+            self._touch(path, stamp)
+        else:
+            self._nodes[path][1] = stamp
+            self._touch(path[:-1], stamp)
+        self._changes.add(path)
+        return None
+
+    def delete(self, path):
+        """
+        Remove the node at PATH and everything under it.
+
+        Raises:
+            KeyError if there is no node at PATH.
+        """
+        if path not in self._nodes:
+            raise KeyError(path)
+        self._forget(path)
+        del self._nodes[path]
+        del self._nodes[path[:-1]][0][path[-1]]
+        self._changes.add(path)
+
+    def find_missing(self, path):
+        """
+        Work out why there's no node at PATH.
+
+        Returns:
+            A tuple of (index into PATH of the first key that isn't there,
+            the dict or leaf value it was looked up in).
+        """
+        for index in range(len(path)):
+            parent = path[:index]
+            if parent not in self._dicts or path[:index + 1] not in self._nodes:
+                return index, self._nodes[parent][0]
+        return len(path) - 1, {}
+
+    def _touch(self, path, stamp):
+        """
+        Note that something was written at STAMP under the dict at PATH.
+        """
+        pending = self._pending
+        while pending.get(path, -1) < stamp:
+            pending[path] = stamp
+            if not path:
+                break
+            path = path[:-1]
+
+    def _refresh(self, path):
+        """
+        Bring the timestamp of the dict at PATH up to date.
+        """
+        node = self._nodes[path]
+        node[1] = max(node[1], self._pending.pop(path))
+
+    def _forget(self, path):
+        """
+        Drop everything under the node at PATH from the index, and stop
+        treating it as a dict.
+        """
+        if path not in self._dicts:
+            return
+        for key in self._nodes[path][0]:
+            child = path + (key,)
+            self._forget(child)
+            del self._nodes[child]
+        self._dicts.discard(path)
+        self._pending.pop(path, None)
+
+
 class StateManager(object): # pylint: disable=too-many-public-methods
 
     """input is a multiprocessing.Queue object to support multiple
     processes requesting state data
     """
 
-    def __init__(self, badThingsQueue, inputQueue, runtimePipe):
+    def __init__(self, badThingsQueue, inputQueue, runtimePipe, latencyTrace=None):
+        # Version of the telemetry last sent to the UDP sender (see send_ansible)
+        self.telemetry_version = 0
         self.init_robot_state()
         self.bad_things_queue = badThingsQueue
+        # When there is one, how long hibike's device values take to be
+        # applied is recorded in it
+        self.latency_trace = latencyTrace
         self.input_ = inputQueue
         self.command_mapping = self.make_command_map()
         self.hibike_mapping = self.make_hibike_map()
         self.hibike_response_mapping = self.make_hibike_response_map()
-        self.device_name_to_subscribe_params = self.make_subscription_map()
         self.process_mapping = {PROCESS_NAMES.RUNTIME: runtimePipe}
-
-    @staticmethod
-    def make_subscription_map():
-        subscription_map = {
-            "LimitSwitch": ["switch0", "switch1", "switch2"],
-            "LineFollower": ["left", "center", "right"],
-            "Potentiometer": ["pot0", "pot1", "pot2"],
-            "BatteryBuzzer": ["v_batt", "is_unsafe"],
-            "ServoControl": ["servo0", "servo1"],
-            "YogiBear": ["duty_cycle", "enc_pos", "enc_vel"],
-            "RFID": ["id", "tag_detect"],
-            "ExampleDevice": ["hazuki", "sapphire", "reina", "asuka"]
-        }
-        return subscription_map
+        # ID of the request from student code being handled, if it has one
+        self.request_id = None
+        # [request ID, reply] for requests from student code that haven't been sent yet
+        self.student_replies = []
 
     def make_command_map(self):
         command_mapping = {
@@ -68,6 +262,7 @@ class StateManager(object): # pylint: disable=too-many-public-methods
             HIBIKE_COMMANDS.SUBSCRIBE: self.hibike_subscribe_device,
             HIBIKE_COMMANDS.READ: self.hibike_read_params,
             HIBIKE_COMMANDS.WRITE: self.hibike_write_params,
+            HIBIKE_COMMANDS.WRITE_DEVICES: self.hibike_write_devices,
             HIBIKE_COMMANDS.DISABLE: self.hibike_disable,
             HIBIKE_COMMANDS.TIMESTAMP_DOWN: self.hibike_timestamp_down
         }
@@ -84,7 +279,10 @@ class StateManager(object): # pylint: disable=too-many-public-methods
 
     def init_robot_state(self):
         t = time.time()
-        self.state = {
+        # Everything changed, so the UDP sender needs all of it again
+        self.telemetry_version += 1
+        self.state = StateStore()
+        self.state.load({
             "studentCodeState": [2, t],
             "limit_switch": [["limit_switch", 0, 123456], t],
             "incrementer": [2, t],
@@ -104,86 +302,106 @@ class StateManager(object): # pylint: disable=too-many-public-methods
             "gamepads": [{0: {"axes": {0: 0.5, 1: -0.5, 2: 1, 3: -1},
                               "buttons": {0: True, 1: False, 2: True, 3: False, 4: True}}}, t],
             "team_flag_uid": [None, t],
-        }
+        })
+
+    def send_student(self, reply):
+        """
+        Send REPLY to student code. If the request being handled came
+        with an ID (see SM_COMMANDS.REQUEST), the reply is tagged with it
+        and held, to be sent with the other replies to the requests that
+        arrived together (see flush_student_replies).
+        """
+        if self.request_id is None:
+            self.process_mapping[PROCESS_NAMES.STUDENT_CODE].send(reply)
+        else:
+            self.student_replies.append([self.request_id, reply])
+
+    def flush_student_replies(self):
+        """
+        Send student code the tagged replies held for it, as one list.
+        """
+        if self.student_replies:
+            self.process_mapping[PROCESS_NAMES.STUDENT_CODE].send(self.student_replies)
+            self.student_replies = []
 
     def add_pipe(self, process_name, pipe):
         self.process_mapping[process_name] = pipe
         pipe.send(RUNTIME_CONFIG.PIPE_READY.value)
 
     def create_key(self, keys, send=True):
-        curr_dict = self.state
-        path = []
-        for key in keys:
-            try:
-                if key not in curr_dict:
-                    curr_dict[key] = [{}, 0]
-                path.append(curr_dict[key])
-                curr_dict = curr_dict[key][0]
-            except TypeError:
-                error = StudentAPIKeyError(
-                    "key '{}' is defined, but does not contain a dictionary.".format(key))
-                self.process_mapping[PROCESS_NAMES.STUDENT_CODE].send(error)
-                return
-        curr_time = time.time()
-        for item in path:
-            item[1] = curr_time
+        missing = self.state.create(tuple(keys))
+        if missing is not None:
+            error = StudentAPIKeyError(
+                "key '{}' is defined, but does not contain a dictionary.".format(keys[missing]))
+            self.send_student(error)
+            return
         if send:
-            self.process_mapping[PROCESS_NAMES.STUDENT_CODE].send(None)
+            self.send_student(None)
 
     def get_value(self, keys):
-        result = self.state
         try:
-            for i, key in enumerate(keys):
-                result = result[key][0]
-            self.process_mapping[PROCESS_NAMES.STUDENT_CODE].send(result)
-        except:
-            error = StudentAPIKeyError(self.dict_error_message(i, keys, result))
-            self.process_mapping[PROCESS_NAMES.STUDENT_CODE].send(error)
+            result = self.state.get(tuple(keys))
+        except KeyError:
+            result = StudentAPIKeyError(self.key_error_message(keys))
+        self.send_student(result)
 
     def set_value(self, value, keys, send=True):
-        curr_dict = self.state
         try:
-            path = []
-            for i, key in enumerate(keys[:-1]):
-                path.append(curr_dict[key])
-                curr_dict = curr_dict[key][0]
-            if len(keys) > 1:
-                i += 1 # pylint: disable=undefined-loop-variable
-            else:
-                i = 0
-            if keys[i] not in curr_dict:
-                raise Exception
-            path.append(curr_dict[keys[i]])
-            curr_dict[keys[i]][0] = value
-            curr_time = time.time()
-            for item in path:
-                item[1] = curr_time
-            if send:
-                self.process_mapping[PROCESS_NAMES.STUDENT_CODE].send(value)
-        except:
-            error = StudentAPIKeyError(
-                self.dict_error_message(i, keys, curr_dict))
-            if send:
-                self.process_mapping[PROCESS_NAMES.STUDENT_CODE].send(error)
+            self.state.set(tuple(keys), value)
+        except KeyError:
+            value = StudentAPIKeyError(self.key_error_message(keys))
+        if send:
+            self.send_student(value)
 
-    def send_ansible(self):
-        self.process_mapping[PROCESS_NAMES.UDP_SEND_PROCESS].send(self.state)
+    def send_ansible(self, version=None):
+        """
+        Send the UDP sender what has changed in the telemetry for Dawn
+        since VERSION, the version it was last sent (None if it has
+        never been sent one): [new version, whether it's everything,
+        studentCodeState, {uid: {param: value}} for every device added or
+        changed, [uid] for every device removed].
+
+        If VERSION isn't the latest, everything is sent instead.
+        """
+        devices_path = ("hibike", "devices")
+        changes = self.state.take_changes()
+        full = version != self.telemetry_version or any(
+            path == devices_path[:len(path)] for path in changes)
+        if full:
+            changed_uids = self.state.get(devices_path)
+        else:
+            changed_uids = {path[2] for path in changes if path[:2] == devices_path}
+        devices = {}
+        removed = []
+        for uid in changed_uids:
+            device_path = devices_path + (uid,)
+            params = self.state.get(device_path) if device_path in self.state else None
+            if isinstance(params, dict):
+                devices[uid] = {param: value for param, (value, _) in params.items()}
+            else:
+                removed.append(uid)
+        self.telemetry_version += 1
+        self.process_mapping[PROCESS_NAMES.UDP_SEND_PROCESS].send(
+            [self.telemetry_version, full, self.state.get(("studentCodeState",)), devices,
+             removed])
 
     def recv_ansible(self, new_data):
-        self.state.update(new_data)
+        for key, (value, stamp) in new_data.items():
+            self.state.set((key,), value, stamp, create=True)
 
     def set_team(self, team):
-        if self.state["team_flag_uid"][0] is not None:
+        team_flag_uid = self.state.get(("team_flag_uid",))
+        if team_flag_uid is not None:
             self.hibike_write_params(self.process_mapping[PROCESS_NAMES.HIBIKE],
-                                     self.state["team_flag_uid"][0], [(team, True)])
-            self.state["team_flag_uid"] = [None, 0]
+                                     team_flag_uid, [(team, True)])
+            self.state.set(("team_flag_uid",), None, 0)
 
     def set_addr(self, new_addr):
-        self.state["dawn_addr"] = [new_addr, time.time()]
+        self.state.set(("dawn_addr",), new_addr)
         self.bad_things_queue.put(BadThing(sys.exc_info(), None, BAD_EVENTS.NEW_IP, False))
 
     def send_addr(self, process_name):
-        self.process_mapping[process_name].send(self.state["dawn_addr"][0])
+        self.process_mapping[process_name].send(self.state.get(("dawn_addr",)))
 
     def student_upload(self):
         self.bad_things_queue.put(
@@ -199,44 +417,37 @@ class StateManager(object): # pylint: disable=too-many-public-methods
     def enter_auto(self):
         self.bad_things_queue.put(
             BadThing(sys.exc_info(), None, BAD_EVENTS.ENTER_AUTO, False))
-        self.state["studentCodeState"] = [
-            runtime_pb2.RuntimeData.AUTO, time.time()]
+        self.state.set(("studentCodeState",), runtime_pb2.RuntimeData.AUTO)
 
     def enter_teleop(self):
         self.bad_things_queue.put(
             BadThing(sys.exc_info(), None, BAD_EVENTS.ENTER_TELEOP, False))
-        self.state["studentCodeState"] = [
-            runtime_pb2.RuntimeData.TELEOP, time.time()]
+        self.state.set(("studentCodeState",), runtime_pb2.RuntimeData.TELEOP)
 
     def enter_idle(self):
         self.bad_things_queue.put(
             BadThing(sys.exc_info(), None, BAD_EVENTS.ENTER_IDLE, False))
-        self.state["studentCodeState"] = [
-            runtime_pb2.RuntimeData.STUDENT_STOPPED, time.time()]
+        self.state.set(("studentCodeState",), runtime_pb2.RuntimeData.STUDENT_STOPPED)
 
     def get_timestamp(self, keys):
-        curr_dict = self.state
-        timestamp = 0
         try:
-            for i, key in enumerate(keys):
-                curr_dict, timestamp = curr_dict[key]
-            self.process_mapping[PROCESS_NAMES.STUDENT_CODE].send(timestamp)
-        except:
-            error = StudentAPIKeyError(self.dict_error_message(i, keys, curr_dict))
-            self.process_mapping[PROCESS_NAMES.STUDENT_CODE].send(error)
+            timestamp = self.state.timestamp(tuple(keys))
+        except KeyError:
+            timestamp = StudentAPIKeyError(self.key_error_message(keys))
+        self.send_student(timestamp)
 
     def student_code_tick(self):
-        self.state["runtime_meta"][0]["studentCode_main_count"][0] += 1
+        path = ("runtime_meta", "studentCode_main_count")
+        self.state.set(path, self.state.get(path) + 1)
 
     def emergency_stop(self):
-        self.state["runtime_meta"][0]["e_stopped"][0] = True
+        self.state.set(("runtime_meta", "e_stopped"), True)
         self.bad_things_queue.put(BadThing(sys.exc_info(
         ), "Emergency Stop Activated", event=BAD_EVENTS.EMERGENCY_STOP, printStackTrace=False))
-        self.state["studentCodeState"] = [
-            runtime_pb2.RuntimeData.ESTOP, time.time()]
+        self.state.set(("studentCodeState",), runtime_pb2.RuntimeData.ESTOP)
 
     def emergency_restart(self):
-        self.state["runtime_meta"][0]["e_stopped"][0] = False
+        self.state.set(("runtime_meta", "e_stopped"), False)
 
     def end_student_code(self):
         self.process_mapping[PROCESS_NAMES.UDP_RECEIVE_PROCESS].send(
@@ -251,50 +462,77 @@ class StateManager(object): # pylint: disable=too-many-public-methods
     def hibike_write_params(self, pipe, uid, param_values):
         pipe.send([HIBIKE_COMMANDS.WRITE.value, [uid, param_values]])
 
+    def hibike_write_devices(self, pipe, writes):
+        """
+        Write to several devices at once. WRITES is {uid: [(param, value)]}.
+        """
+        pipe.send([HIBIKE_COMMANDS.WRITE_DEVICES.value, [writes]])
+
     def hibike_read_params(self, pipe, uid, params):
         pipe.send([HIBIKE_COMMANDS.READ.value, [uid, params]])
 
     def hibike_timestamp_down(self, pipe, *data):
         data = list(data)
-        data.append(time.time())
-        pipe.send(HIBIKE_COMMANDS.TIMESTAMP_DOWN.value, data)
+        data.append(time.monotonic())
+        pipe.send([HIBIKE_COMMANDS.TIMESTAMP_DOWN.value, data])
 
     def hibike_response_device_subbed(self, uid, delay, params):
         if delay == 0:
-            device_name = SENSOR_TYPE[uid >> 72]
-            if device_name == "TeamFlag":
+            device = DEVICE_PARAMS[uid >> 72]
+            if device.name == "TeamFlag":
                 self.set_value(uid, ["team_flag_uid"], send=False)
-            if device_name in self.device_name_to_subscribe_params:
+            if device.subscribe is not None:
                 self.hibike_subscribe_device(
-                    self.process_mapping[PROCESS_NAMES.HIBIKE], uid, 40,
-                    self.device_name_to_subscribe_params[device_name])
+                    self.process_mapping[PROCESS_NAMES.HIBIKE], uid, 40, device.subscribe)
         self.create_key(["hibike", "devices", uid], send=False)
         for param in params:
             self.create_key(["hibike", "devices", uid, param], send=False)
             self.set_value(None, ["hibike", "devices", uid, param], send=False)
-        self.state["hibike"][0]["device_subscribed"][0] += 1
+        path = ("hibike", "device_subscribed")
+        self.state.set(path, self.state.get(path) + 1)
 
-    def hibike_response_device_values(self, data):
+    def hibike_response_device_values(self, data, published=None, received=None):
+        """
+        Store the values in DATA. When tracing latency, hibike also sends
+        when it PUBLISHED them, and when it RECEIVED the oldest value of
+        each device.
+        """
+        now = time.time()
+        state = self.state
         for uid, params in data.items():
             for key, value in params:
-                self.set_value(value, ["hibike", "devices", uid, key], send=False)
+                try:
+                    state.set(("hibike", "devices", uid, key), value, now)
+                except KeyError:
+                    pass
+        if self.latency_trace is not None and published is not None:
+            now = time.monotonic()
+            self.latency_trace.record("publish_to_apply", now - published)
+            for uid_received in received.values():
+                self.latency_trace.record("receive_to_apply", now - uid_received)
 
     # pylint: disable=invalid-name
     def hibike_response_device_disconnect(self, uid):
         """
         Delete any history of the device at UID.
         """
-        devs = self.state["hibike"][0]["devices"][0]
-        del devs[uid]
+        self.state.delete(("hibike", "devices", uid))
 
     def hibike_response_timestamp_up(self, *data):
         data = list(data)
-        data.append(time.time())
-        self.bad_things_queue.put(BadThing(sys.exc_info, data, BAD_EVENTS.TIMESTAMP_UP, False))
+        data.append(time.monotonic())
+        self.bad_things_queue.put(BadThing(sys.exc_info(), data, BAD_EVENTS.TIMESTAMP_UP, False))
 
     def hibike_disable(self, pipe):
         pipe.send([HIBIKE_COMMANDS.DISABLE.value, []])
 
+    def key_error_message(self, keys):
+        """
+        Describe why there is nothing in the state at KEYS.
+        """
+        errored_index, curr_dict = self.state.find_missing(tuple(keys))
+        return self.dict_error_message(errored_index, keys, curr_dict)
+
     def dict_error_message(self, errored_index, keys, curr_dict):
         key_chain = ""
         i = 0
@@ -328,32 +566,53 @@ class StateManager(object): # pylint: disable=too-many-public-methods
 
     def start(self):
         while True:
-            try:
-                request = self.input_.get(block=True)
-                cmd_type = request[0]
-                args = request[1]
-                if len(request) != 2:
-                    self.bad_things_queue.put(BadThing(sys.exc_info(),
-                                                       "Wrong input size, need list of size 2",
-                                                       event=BAD_EVENTS.UNKNOWN_PROCESS,
-                                                       printStackTrace=False))
-                elif cmd_type in self.command_mapping:
-                    command = self.command_mapping[cmd_type]
-                    command(*args)
-                elif cmd_type in self.hibike_mapping:
-                    if not self.state["runtime_meta"][0]["e_stopped"][0]:
-                        command = self.hibike_mapping[cmd_type]
-                        command(self.process_mapping[PROCESS_NAMES.HIBIKE], *args)
-                elif cmd_type in self.hibike_response_mapping:
-                    command = self.hibike_response_mapping[cmd_type]
-                    command(*args)
-                else:
-                    self.bad_things_queue.put(BadThing(sys.exc_info(),
-                                                       "Unknown process name: %s" % (request,),
-                                                       event=BAD_EVENTS.UNKNOWN_PROCESS,
-                                                       printStackTrace=False))
-            except Exception as e:
+            requests = [self.input_.get(block=True)]
+            # Take everything else that has arrived too, so a burst of
+            # messages is handled in one wakeup
+            while True:
+                try:
+                    requests.append(self.input_.get_nowait())
+                except queue.Empty:
+                    break
+            for request in requests:
+                self.handle_request(request)
+            self.flush_student_replies()
+
+    def handle_request(self, request):
+        try:
+            cmd_type = request[0]
+            args = request[1]
+            if len(request) != 2:
+                self.bad_things_queue.put(BadThing(sys.exc_info(),
+                                                   "Wrong input size, need list of size 2",
+                                                   event=BAD_EVENTS.UNKNOWN_PROCESS,
+                                                   printStackTrace=False))
+            elif cmd_type == SM_COMMANDS.BATCH:
+                for batched_request in args:
+                    self.handle_request(batched_request)
+            elif cmd_type == SM_COMMANDS.REQUEST:
+                self.request_id, tagged_request = args
+                try:
+                    self.handle_request(tagged_request)
+                finally:
+                    self.request_id = None
+            elif cmd_type in self.command_mapping:
+                command = self.command_mapping[cmd_type]
+                command(*args)
+            elif cmd_type in self.hibike_mapping:
+                if not self.state.get(("runtime_meta", "e_stopped")):
+                    command = self.hibike_mapping[cmd_type]
+                    command(self.process_mapping[PROCESS_NAMES.HIBIKE], *args)
+            elif cmd_type in self.hibike_response_mapping:
+                command = self.hibike_response_mapping[cmd_type]
+                command(*args)
+            else:
                 self.bad_things_queue.put(BadThing(sys.exc_info(),
-                                                   "State Manager Loop crash with: " + str(e),
-                                                   event=BAD_EVENTS.STATE_MANAGER_CRASH,
-                                                   printStackTrace=True))
+                                                   "Unknown process name: %s" % (request,),
+                                                   event=BAD_EVENTS.UNKNOWN_PROCESS,
+                                                   printStackTrace=False))
+        except Exception as e:
+            self.bad_things_queue.put(BadThing(sys.exc_info(),
+                                               "State Manager Loop crash with: " + str(e),
+                                               event=BAD_EVENTS.STATE_MANAGER_CRASH,
+                                               printStackTrace=True))
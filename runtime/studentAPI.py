@@ -4,6 +4,7 @@ import csv
 import asyncio
 import inspect
 import io
+import time
 
 from runtimeUtil import *
 
@@ -14,30 +15,224 @@ class Actions:
         await asyncio.sleep(seconds)
 
 
+class ManagerClient:
+    """Sends requests to the state manager, and matches up its replies.
+
+    Every request is numbered, and the state manager tags its reply with the number (see
+    SM_COMMANDS.REQUEST), so any number of requests can be made before waiting for their
+    replies, which can then be waited for in any order. Replies that arrive while waiting
+    for a different one are kept until they're asked for, unless nothing can ask for them
+    any more (see `abandon`).
+
+    Requests are held until something waits for a reply, or `take_requests` is called
+    (which the student code loop does every tick), and then sent together in one message.
+
+    There is one client per pipe from the state manager, shared by everything that uses
+    the pipe (see `for_pipe`), since any of them could read the others' replies.
+    """
+
+    # Pipe from the state manager: its client
+    _clients = {}
+
+    @classmethod
+    def for_pipe(cls, to_manager, from_manager):
+        client = cls._clients.get(from_manager)
+        if client is None:
+            client = cls._clients[from_manager] = cls(to_manager, from_manager)
+        return client
+
+    def __init__(self, to_manager, from_manager):
+        self.to_manager = to_manager
+        self.from_manager = from_manager
+        self.next_id = 0
+        # IDs of requests whose replies haven't arrived yet
+        self.in_flight = set()
+        # IDs of requests in flight whose replies nothing is going to collect
+        self.abandoned = set()
+        # Requests that haven't been sent yet
+        self.unsent = []
+        # Request ID: reply, for replies that arrived before anything waited for them
+        self.replies = {}
+        # Request ID: future, for replies being awaited
+        self.futures = {}
+        # Event loop watching the pipe for replies being awaited, if there is one
+        self.reading_loop = None
+        # Whether the event loop is going to send the requests soon
+        self.flush_scheduled = False
+
+    def request(self, command, args):
+        """Makes a request of COMMAND with ARGS to the state manager.
+
+        Returns:
+            A PendingReply for the reply.
+        """
+        request_id = self.next_id
+        self.next_id += 1
+        self.in_flight.add(request_id)
+        self.unsent.append([SM_COMMANDS.REQUEST, [request_id, [command, args]]])
+        return PendingReply(self, request_id)
+
+    def call(self, command, args):
+        """Makes a request of COMMAND with ARGS to the state manager, and waits for the
+        reply. With no other requests waiting for replies, the request isn't tagged,
+        since the next reply has to be its own.
+
+        Returns:
+            The reply; if it is an exception, that is raised instead.
+        """
+        if self.in_flight:
+            return self.request(command, args).result()
+        self.to_manager.put([command, args])
+        return self._unwrap(self.from_manager.recv())
+
+    def take_requests(self):
+        """Returns the commands for the requests that haven't been sent yet, which the
+        caller must send.
+        """
+        unsent = self.unsent
+        self.unsent = []
+        return unsent
+
+    def flush(self):
+        """Sends the requests that haven't been sent yet.
+        """
+        put_commands(self.to_manager, self.take_requests())
+
+    def result(self, request_id):
+        """Waits for the reply to the request with REQUEST_ID.
+
+        Returns:
+            The reply; if it is an exception, that is raised instead.
+        """
+        self.abandoned.discard(request_id)
+        self.flush()
+        while request_id not in self.replies:
+            self._receive()
+        return self._unwrap(self.replies.pop(request_id))
+
+    async def result_async(self, request_id):
+        """The same as `result`, but lets other coroutines run while waiting.
+
+        The requests aren't sent until the coroutines that are ready to run have had a
+        chance to, so the requests they make go in the same message.
+        """
+        if request_id in self.replies:
+            return self._unwrap(self.replies.pop(request_id))
+        self.abandoned.discard(request_id)
+        loop = asyncio.get_event_loop()
+        if not self.flush_scheduled:
+            loop.call_soon(self._scheduled_flush)
+            self.flush_scheduled = True
+        future = loop.create_future()
+        self.futures[request_id] = future
+        if self.reading_loop is None:
+            loop.add_reader(self.from_manager.fileno(), self._receive_ready)
+            self.reading_loop = loop
+        try:
+            return self._unwrap(await future)
+        finally:
+            self.futures.pop(request_id, None)
+
+    def abandon(self, request_id):
+        """Throws away the reply to the request with REQUEST_ID, now or when it arrives,
+        since nothing is going to collect it. Waiting for it again takes that back, if it
+        hasn't arrived yet.
+        """
+        if request_id in self.replies:
+            del self.replies[request_id]
+        elif request_id in self.in_flight:
+            self.abandoned.add(request_id)
+
+    def _scheduled_flush(self):
+        self.flush_scheduled = False
+        self.flush()
+
+    def _receive(self):
+        """Waits for replies, and hands them to whatever is waiting for them.
+        """
+        replies = self.from_manager.recv()
+        for request_id, reply in replies:
+            self.in_flight.discard(request_id)
+            if request_id in self.abandoned:
+                self.abandoned.discard(request_id)
+                continue
+            future = self.futures.pop(request_id, None)
+            if future is None:
+                self.replies[request_id] = reply
+            elif not future.cancelled():
+                future.set_result(reply)
+
+    def _receive_ready(self):
+        """Takes every reply that has arrived, while replies are being awaited.
+        """
+        while self.from_manager.poll():
+            self._receive()
+        if not self.futures:
+            self.reading_loop.remove_reader(self.from_manager.fileno())
+            self.reading_loop = None
+
+    @staticmethod
+    def _unwrap(reply):
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+
+class PendingReply:
+    """The reply to a request to the state manager, which may not have arrived yet.
+
+    `result()` waits for it; awaiting it waits without holding up other coroutines.
+    Either raises the reply instead if it is an exception. If it is dropped without
+    either, or its wait is cancelled and nothing else holds it, the reply is thrown away.
+    """
+
+    def __init__(self, client, request_id):
+        self.client = client
+        self.request_id = request_id
+
+    def __del__(self):
+        self.client.abandon(self.request_id)
+
+    def result(self):
+        return self.client.result(self.request_id)
+
+    def __await__(self):
+        # Written as a generator, so this stays alive until the wait is over, and only
+        # abandons the reply once nothing is waiting for it or can wait for it again
+        return (yield from self.client.result_async(self.request_id).__await__())
+
+
 class StudentAPI:
     def __init__(self, toManager, fromManager):
         self.from_manager = fromManager
         self.to_manager = toManager
+        self._client = ManagerClient.for_pipe(toManager, fromManager)
 
     def _get_sm_value(self, key, *args):
         """Returns the value associated with key.
         """
-        self.to_manager.put([SM_COMMANDS.GET_VAL, [[key] + list(args)]])
-        message = self.from_manager.recv()
-        if isinstance(message, Exception):
-            raise message
-        return message
+        return self._client.call(SM_COMMANDS.GET_VAL, [[key] + list(args)])
 
     def _set_sm_value(self, value, key, *args):
         """Sets the value associated with key.
         """
-        # statemanager passes exception, then check to see if returned value is
-        # exception or not
-        self.to_manager.put([SM_COMMANDS.SET_VAL, [value, [key] + list(args)]])
-        message = self.from_manager.recv()
-        if isinstance(message, Exception):
-            raise message
-        return message
+        return self._client.call(SM_COMMANDS.SET_VAL, [value, [key] + list(args)])
+
+    def _get_sm_value_async(self, key, *args):
+        """Asks for the value associated with key, without waiting for it.
+
+        Returns:
+            A PendingReply: `result()` it, or await it from a coroutine.
+        """
+        return self._client.request(SM_COMMANDS.GET_VAL, [[key] + list(args)])
+
+    def _set_sm_value_async(self, value, key, *args):
+        """Sets the value associated with key, without waiting for it to be set.
+
+        Returns:
+            A PendingReply: `result()` it, or await it from a coroutine.
+        """
+        return self._client.request(SM_COMMANDS.SET_VAL, [value, [key] + list(args)])
 
 
 class Gamepad(StudentAPI):
@@ -84,56 +279,72 @@ class Gamepad(StudentAPI):
 
 
 class Robot(StudentAPI):
-    deviceName_to_writeParams = {
-        "TeamFlag": ["led1", "led2", "led3", "led4"],
-        "ServoControl": ["servo0", "servo1"],
-        "YogiBear": ["duty_cycle", "pid_pos_setpoint", "pid_pos_kp", "pid_pos_ki",
-                     "pid_pos_kd", "current_thresh", "enc_pos"],
-    }
-    deviceName_to_readParams = {
-        "LimitSwitch": ["switch0", "switch1", "switch2"],
-        "LineFollower": ["left", "center", "right"],
-        "Potentiometer": ["pot0", "pot1", "pot2"],
-        "ServoControl": ["servo0", "servo1"],
-        "YogiBear": ["duty_cycle", "enc_pos", "enc_vel"],
-        "RFID": ["id", "tag_detect"],
-    }
-    param_to_valid_values = {
-        "servo0": [(float, int), -1, 1],
-        "servo1": [(float, int), -1, 1],
-        "duty_cycle": [(float, int), -1, 1],
-        "pid_pos_setpoint": [(float, int), -float("inf"), float("inf")],
-        "pid_pos_kp": [(float, int), 0, float("inf")],
-        "pid_pos_ki": [(float, int), 0, float("inf")],
-        "pid_pos_kd": [(float, int), 0, float("inf")],
-        "current_thresh": [(float, int), 2, 10],
-        "enc_pos": [(float, int), 0, 0],
-        "led1": [(bool,)],
-        "led2": [(bool,)],
-        "led3": [(bool,)],
-        "led4": [(bool,)],
-    }
-
-    def __init__(self, toManager, fromManager):
+    def __init__(self, toManager, fromManager, sensorTable=None, latencyTrace=None):
         super().__init__(toManager, fromManager)
+        # Device values shared with hibike. When there is one, device values
+        # are read straight from it instead of being fetched every tick.
+        self._sensor_table = sensorTable
+        # When there is one, the age of every value read from the sensor
+        # table is recorded in it
+        self._latency_trace = latencyTrace
+        self.peripherals = {}
+        # (UID, param): value, for writes not sent to hibike yet. They are all sent
+        # together once per tick, keeping the last value written to each param.
+        self._pending_writes = {}
+        # (UID, param): (value, `time.monotonic` time), for the last value sent to each
+        # device param. Writing the same value again isn't sent until
+        # STUDENT_WRITE_REFRESH seconds later.
+        self._sent_writes = {}
         self._create_sensor_mapping()
         self._coroutines_running = set()
         self._stdout_buffer = io.StringIO()
         self._get_all_sensors()
 
     def _get_all_sensors(self):
-        self.peripherals = self._get_sm_value('hibike', 'devices')
+        if self._sensor_table is None:
+            self.peripherals = self._get_sm_value('hibike', 'devices')
 
     def get_value(self, device_name, param):
         uid = self._hibike_get_uid(device_name)
         self._check_read_params(uid, param)
+        if self._sensor_table is not None:
+            try:
+                value = self._sensor_table.get_value(uid, param)
+                if self._latency_trace is not None:
+                    updated = self._sensor_table.get_update_time(uid)
+                    if updated is not None:
+                        self._latency_trace.record("receive_to_read", time.monotonic() - updated)
+                return value
+            except KeyError:
+                raise StudentAPIKeyError("Device not found: " + str(device_name))
         return self.peripherals[uid][0][param][0]
 
     def set_value(self, device_name, param, value):
         uid = self._hibike_get_uid(device_name)
-        self._check_write_params(uid, param)
-        self._check_value(param, value)
-        self.to_manager.put([HIBIKE_COMMANDS.WRITE, [uid, [(param, value)]]])
+        self._check_value(self._check_write_params(uid, param), value)
+        self._pending_writes[(uid, param)] = value
+
+    def _write_commands(self):
+        """Returns the commands that send the writes made since last time to hibike,
+        leaving out values that were sent recently.
+        """
+        if not self._pending_writes:
+            return []
+        now = time.monotonic()
+        refresh = RUNTIME_CONFIG.STUDENT_WRITE_REFRESH.value
+        writes = {}
+        for key, value in self._pending_writes.items():
+            sent = self._sent_writes.get(key)
+            if (sent is not None and sent[0] == value and type(sent[0]) is type(value)
+                    and now - sent[1] < refresh):
+                continue
+            self._sent_writes[key] = (value, now)
+            uid, param = key
+            writes.setdefault(uid, []).append((param, value))
+        self._pending_writes = {}
+        if not writes:
+            return []
+        return [[HIBIKE_COMMANDS.WRITE_DEVICES, [writes]]]
 
     def run(self, func, *args, **kwargs):
         """
@@ -173,34 +384,24 @@ class Robot(StudentAPI):
         return func in self._coroutines_running
 
     def _check_write_params(self, uid, param):
-        device_type = uid >> 72
-        valid_params = self.deviceName_to_writeParams[SENSOR_TYPE[device_type]]
-        if param not in valid_params:
-            raise StudentAPITypeError(
-                "Invalid param passed in, valid parameters for this device are: "
-                + ", ".join(valid_params))
+        """Returns the ParamCheck for values written to PARAM of the device at UID.
+        """
+        device = DEVICE_PARAMS[uid >> 72]
+        try:
+            return device.write[param]
+        except KeyError:
+            raise StudentAPITypeError(device.write_error)
 
     def _check_read_params(self, uid, param):
-        device_type = uid >> 72
-        valid_params = self.deviceName_to_readParams[SENSOR_TYPE[device_type]]
-        if param not in valid_params:
-            raise StudentAPITypeError(
-                "Invalid param passed in, valid parameters for this device are: "
-                + ", ".join(valid_params))
-
-    def _check_value(self, param, value):
-        valid_values = self.param_to_valid_values[param]
-        if not isinstance(value, valid_values[0]):
-            raise StudentAPIValueError(
-                "Invalid value type passed in, valid types for this param are: "
-                + valid_values[0][0].__name__)
-        if valid_values[0][0] == bool:
-            return
-        elif valid_values[0][0] == float or valid_values[0][0] == int:
-            if not valid_values[1] <= value <= valid_values[2]:
-                raise StudentAPIValueError(
-                    "Invalid value passed in, valid values for this param are: "
-                    + str(valid_values[1]) + " to " + str(valid_values[2]))
+        device = DEVICE_PARAMS[uid >> 72]
+        if param not in device.read:
+            raise StudentAPITypeError(device.read_error)
+
+    def _check_value(self, check, value):
+        if not isinstance(value, check.types):
+            raise StudentAPIValueError(check.type_error)
+        if check.low is not None and not check.low <= value <= check.high:
+            raise StudentAPIValueError(check.bounds_error)
 
     def _create_sensor_mapping(self, filename="namedPeripherals.csv"):
         with open(filename, "r") as f:
@@ -212,19 +413,28 @@ class Robot(StudentAPI):
         """ Creates a new key, or nested keys if more than 1 key is passed in.
             If any nested key does not exist, it will be created.
         """
-        self.to_manager.put([SM_COMMANDS.CREATE_KEY, [[key] + list(args)]])
-        message = self.from_manager.recv()
-        if isinstance(message, StudentAPIKeyError):
-            raise message
+        self._client.call(SM_COMMANDS.CREATE_KEY, [[key] + list(args)])
 
     def get_timestamp(self, key, *args):
         """Returns the value associated with key.
         """
-        self.to_manager.put([SM_COMMANDS.GET_TIME, [[key] + list(args)]])
-        message = self.from_manager.recv()
-        if isinstance(message, StudentAPIKeyError):
-            raise message
-        return message
+        return self._client.call(SM_COMMANDS.GET_TIME, [[key] + list(args)])
+
+    def create_key_async(self, key, *args):
+        """The same as `create_key`, without waiting for the key to be created.
+
+        Returns:
+            A PendingReply: `result()` it, or await it from a coroutine.
+        """
+        return self._client.request(SM_COMMANDS.CREATE_KEY, [[key] + list(args)])
+
+    def get_timestamp_async(self, key, *args):
+        """The same as `get_timestamp`, without waiting for the timestamp.
+
+        Returns:
+            A PendingReply: `result()` it, or await it from a coroutine.
+        """
+        return self._client.request(SM_COMMANDS.GET_TIME, [[key] + list(args)])
 
     # TODO: Only for testing. Remove in final version
     def _hibike_subscribe_device(self, uid, delay, params):
@@ -236,6 +446,8 @@ class Robot(StudentAPI):
             # TODO: Implement sensor mappings, right now uid is the number (or string of number)
             if int(name) in self.peripherals:
                 return int(name)
+            elif self._sensor_table is not None and int(name) in self._sensor_table:
+                return int(name)
             else:
                 raise StudentAPIKeyError("Device not found: " + str(name))
             # return self.sensor_mappings[name]
@@ -255,10 +467,16 @@ class Robot(StudentAPI):
         return print(*args, sep=sep, end=end, flush=flush)
 
     def _send_prints(self):
+        put_commands(self.to_manager, self._print_commands())
+
+    def _print_commands(self):
+        """Returns the commands that send what has been printed since last time to Dawn.
+        """
         console_string = self._stdout_buffer.getvalue()
-        if console_string:
-            self._stdout_buffer = io.StringIO()
-            self.to_manager.put([SM_COMMANDS.SEND_CONSOLE, [console_string]])
+        if not console_string:
+            return []
+        self._stdout_buffer = io.StringIO()
+        return [[SM_COMMANDS.SEND_CONSOLE, [console_string]]]
 
     def hibike_write_value(self, uid, params):
         self.to_manager.put([HIBIKE_COMMANDS.WRITE, [uid, params]])
@@ -206,6 +206,27 @@ async def asyncIsRunningHelper():
     await Actions.sleep(1)
 
 
+def pipelinedGetVal_setup():
+    Robot.create_key("pipelined")
+    Robot._set_sm_value(0, "pipelined")
+    Robot.run(pipelinedGetVal_helper)
+
+
+def pipelinedGetVal_main():
+    replies = [Robot._get_sm_value_async("int1"), Robot._get_sm_value_async("Klefki"),
+               Robot._get_sm_value_async("float1")]
+    print("Got:", replies[0].result(), replies[2].result())
+    try:
+        replies[1].result()
+    except StudentAPIKeyError:
+        print("Missing key raised")
+
+
+async def pipelinedGetVal_helper():
+    await Robot._set_sm_value_async(5, "pipelined")
+    print("Awaited:", await Robot._get_sm_value_async("pipelined"))
+
+
 def optionalapiGetVal_setup():
     Robot.create_key("hibike", "devices", 47223664828696452136960, "duty_cycle")
     Robot._set_sm_value(0.5, "hibike", "devices",